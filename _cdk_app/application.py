@@ -181,13 +181,20 @@ class WasteCollectionStack(cdk.Stack):
             memory_size = 512,
             environment = {
                 'SQS_URL': historical_queue.queue_url,
-                'KEYS_BUCKET': keys_bucket.bucket_name
+                'KEYS_BUCKET': keys_bucket.bucket_name,
+                'CHECKPOINT_BUCKET': data_bucket.bucket_name
             },
         )
 
         ## Grant to S3 buckets for IoT keys
         keys_bucket.grant_read_write(data_generator_lambda)
 
+        ## Grant to S3 bucket for historical backfill checkpoints
+        data_bucket.grant_read_write(data_generator_lambda)
+
+        ## Grant to invoke itself for fanned out and continued backfills
+        data_generator_lambda.grant_invoke(data_generator_lambda)
+
         ## Grant to ECR for container pull
         data_generator_lambda.role.add_managed_policy(
             iam.ManagedPolicy.from_aws_managed_policy_name("AmazonEC2ContainerRegistryReadOnly"))
@@ -341,10 +348,14 @@ class WasteCollectionStack(cdk.Stack):
             architectures = [_lambda.Architecture.X86_64],
             timeout = cdk.Duration.seconds(900),
             memory_size = 512,
+            # Sorted runs of the partitions being compacted are spilled to /tmp
+            ephemeral_storage_size = cdk.Size.gibibytes(10),
             environment = {
                 'DATA_BUCKET': data_bucket.bucket_name
             },
             function_name = "WasteCollection-ParquetCompact",
+            # Runs overlap on the 5 minute schedule, a single instance keeps them off the same partitions
+            reserved_concurrent_executions = 1,
             log_retention = logs.RetentionDays.ONE_DAY
         )
 
@@ -373,7 +384,7 @@ class WasteCollectionStack(cdk.Stack):
         # Cloudwatch Event to trigger lambda every 5 minutes
         events.Rule(self, "RunEvery5Minutes",
             schedule = events.Schedule.rate(cdk.Duration.minutes(5)),
-            targets = []
+            targets = [parquet_compact_lambda_target]
         )
 
         # Cloudwatch Event to trigger lambda every 60 minutes
@@ -533,6 +544,51 @@ class WasteCollectionStack(cdk.Stack):
             )
         )
 
+        # BATCH SPLITTER FUNCTION
+        ## Param store to track latest build number
+        batch_splitter_latest_image = ssm.StringParameter.from_string_parameter_name(self, "BatchSplitterLatestImage",
+            string_parameter_name = "/WasteCollection/BatchSplitter/LatestImage").string_value
+
+        ## Function, fans per city batches back out to per reading Firehose records and truck metrics
+        batch_splitter_lambda = _lambda.DockerImageFunction(self, 'WasteCollection-BatchSplitter',
+            code = _lambda.DockerImageCode.from_ecr(
+                repository = ecr_repo[6],
+                tag = batch_splitter_latest_image),
+            architectures = [_lambda.Architecture.X86_64],
+            timeout = cdk.Duration.seconds(60),
+            memory_size = 256,
+            environment = {
+                'DELIVERY_STREAM': waste_collection_firehose.delivery_stream_name
+            },
+            function_name = "WasteCollection-BatchSplitter",
+            log_retention = logs.RetentionDays.ONE_DAY
+        )
+
+        ## Firehose and Cloudwatch grants
+        waste_collection_firehose.grant_put_records(batch_splitter_lambda)
+        batch_splitter_lambda.add_to_role_policy(iam.PolicyStatement(
+            actions = ["cloudwatch:PutMetricData"],
+            resources = ["*"]
+        ))
+
+        # IoT rule to split batched city messages
+        batch_topic_rule = iot.CfnTopicRule(self, "WasteCollectionTopicRule_BatchSplitter",
+            rule_name = "WasteCollectionTopicRuleBatchSplitter",
+            topic_rule_payload = iot.CfnTopicRule.TopicRulePayloadProperty(
+                actions = [iot.CfnTopicRule.ActionProperty(
+                    lambda_ = iot.CfnTopicRule.LambdaActionProperty(
+                        function_arn = batch_splitter_lambda.function_arn
+                ))],
+                sql = "SELECT * FROM 'waste/household/city/+/batch'",
+                aws_iot_sql_version = "2016-03-23"
+            )
+        )
+
+        batch_splitter_lambda.add_permission("WasteCollectionBatchSplitterIotInvoke",
+            principal = iam.ServicePrincipal("iot.amazonaws.com"),
+            source_arn = batch_topic_rule.attr_arn
+        )
+
 #   _____ _            
 #  / ____| |           
 # | |  __| |_   _  ___ 
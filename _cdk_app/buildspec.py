@@ -9,7 +9,8 @@ build_spec = {
                 "echo $POSTCODE_CACHE_WARMER_REPO",
                 "echo $POSTCODE_CACHE_QUEUER_REPO",
                 "echo $HISTORICAL_WRITER",
-                "echo $PARQUET_COMPACT"
+                "echo $PARQUET_COMPACT",
+                "echo $BATCH_SPLITTER"
             ]
         },
         "pre_build": {
@@ -29,11 +30,13 @@ build_spec = {
                 "echo $TAG_NAME",
                 "echo ££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££",
                 "cd src/data_generator",
+                "cp ../common/wire_format.py .",
                 "aws ssm put-parameter --name \"/WasteCollection/DataGenerator/LatestImage\" --type \"String\" --value $LATEST_IMAGE_TAG --overwrite",
                 "docker build --no-cache -t $DATA_GENERATOR_REPO:$TAG_NAME .",
                 "docker tag $DATA_GENERATOR_REPO:$TAG_NAME $DATA_GENERATOR_REPO:latest",
                 "echo ££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££",
                 "cd ../data_transform",
+                "cp ../common/wire_format.py ../common/processed_schema.py .",
                 "aws ssm put-parameter --name \"/WasteCollection/DataTransform/LatestImage\" --type \"String\" --value $LATEST_IMAGE_TAG --overwrite",
                 "docker build --no-cache -t $DATA_TRANSFORM_REPO:$TAG_NAME .",
                 "docker tag $DATA_TRANSFORM_REPO:$TAG_NAME $DATA_TRANSFORM_REPO:latest",
@@ -49,14 +52,21 @@ build_spec = {
                 "docker tag $POSTCODE_CACHE_QUEUER_REPO:$TAG_NAME $POSTCODE_CACHE_QUEUER_REPO:latest",
                 "echo ££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££",
                 "cd ../historical_writer",
+                "cp ../common/wire_format.py .",
                 "aws ssm put-parameter --name \"/WasteCollection/HistoricalWriter/LatestImage\" --type \"String\" --value $LATEST_IMAGE_TAG --overwrite",
                 "docker build --no-cache -t $HISTORICAL_WRITER:$TAG_NAME .",
                 "docker tag $HISTORICAL_WRITER:$TAG_NAME $HISTORICAL_WRITER:latest",
                 "echo ££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££",
                 "cd ../parquet_compact",
+                "cp ../common/processed_schema.py .",
                 "aws ssm put-parameter --name \"/WasteCollection/ParquetCompact/LatestImage\" --type \"String\" --value $LATEST_IMAGE_TAG --overwrite",
                 "docker build --no-cache -t $PARQUET_COMPACT:$TAG_NAME .",
                 "docker tag $PARQUET_COMPACT:$TAG_NAME $PARQUET_COMPACT:latest",
+                "echo ££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££££",
+                "cd ../batch_splitter",
+                "aws ssm put-parameter --name \"/WasteCollection/BatchSplitter/LatestImage\" --type \"String\" --value $LATEST_IMAGE_TAG --overwrite",
+                "docker build --no-cache -t $BATCH_SPLITTER:$TAG_NAME .",
+                "docker tag $BATCH_SPLITTER:$TAG_NAME $BATCH_SPLITTER:latest",
             ]
         },
         "post_build": {
@@ -74,6 +84,8 @@ build_spec = {
                 "docker push $HISTORICAL_WRITER:latest",
                 "docker push $PARQUET_COMPACT:$TAG_NAME",
                 "docker push $PARQUET_COMPACT:latest",
+                "docker push $BATCH_SPLITTER:$TAG_NAME",
+                "docker push $BATCH_SPLITTER:latest",
                 "echo Build complete"
             ]
         }
@@ -50,6 +50,11 @@ class PipelineStack(cdk.Stack):
         )
         ecr_repo_parquet_compact.add_lifecycle_rule(max_image_count=10)
 
+        ecr_repo_batch_splitter = ecr.Repository(self, "ecr_repo_batch_splitter",
+            repository_name="waste_collection_batch_splitter"
+        )
+        ecr_repo_batch_splitter.add_lifecycle_rule(max_image_count=10)
+
 
 #   _____ _ _   _           _     
 #  / ____(_) | | |         | |    
@@ -125,6 +130,7 @@ class PipelineStack(cdk.Stack):
                 "POSTCODE_CACHE_QUEUER_REPO":  f"{self.account}.dkr.ecr.{self.region}.amazonaws.com/{ecr_repo_postcode_cache_queuer.repository_name}",
                 "HISTORICAL_WRITER":  f"{self.account}.dkr.ecr.{self.region}.amazonaws.com/{ecr_repo_historical_writer.repository_name}",
                 "PARQUET_COMPACT":  f"{self.account}.dkr.ecr.{self.region}.amazonaws.com/{ecr_repo_parquet_compact.repository_name}",
+                "BATCH_SPLITTER":  f"{self.account}.dkr.ecr.{self.region}.amazonaws.com/{ecr_repo_batch_splitter.repository_name}",
             }
         )
 
@@ -144,7 +150,8 @@ class PipelineStack(cdk.Stack):
             ecr_repo_postcode_cache_warmer,
             ecr_repo_postcode_cache_queuer,
             ecr_repo_historical_writer,
-            ecr_repo_parquet_compact
+            ecr_repo_parquet_compact,
+            ecr_repo_batch_splitter
         ])
         pipeline.add_stage(waste_collection_app, pre=[container_build])
 
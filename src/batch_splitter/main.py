@@ -0,0 +1,47 @@
+import boto3
+import json
+import os
+from time import sleep
+
+DELIVERY_STREAM = os.environ.get('DELIVERY_STREAM', 'WasteCollectionDeliveryStream')
+METRICS_NAMESPACE = "WasteCollectionTrucks"
+
+# Service limits per call
+FIREHOSE_BATCH_SIZE = 500
+CLOUDWATCH_BATCH_SIZE = 1000
+MAX_RETRIES = 5
+
+firehose = boto3.client('firehose')
+cloudwatch = boto3.client('cloudwatch')
+
+
+def write_to_firehose(readings):
+    # Same comma separator the IoT rule adds for per truck messages
+    records = [{'Data': (json.dumps(reading) + ",").encode("utf-8")} for reading in readings]
+    for i in range(0, len(records), FIREHOSE_BATCH_SIZE):
+        batch = records[i:i + FIREHOSE_BATCH_SIZE]
+        attempt = 0
+        while batch:
+            response = firehose.put_record_batch(DeliveryStreamName=DELIVERY_STREAM, Records=batch)
+            if response['FailedPutCount'] == 0:
+                break
+            batch = [record for record, result in zip(batch, response['RequestResponses']) if 'ErrorCode' in result]
+            attempt += 1
+            if attempt > MAX_RETRIES:
+                raise RuntimeError(f"{len(batch)} records not delivered to {DELIVERY_STREAM}")
+            print(f"PUTFIREHOSE: Retrying {len(batch)} failed records")
+            sleep(min(0.1 * 2 ** attempt, 5))
+
+
+def write_to_cloudwatch(readings):
+    metrics = [{'MetricName': reading['truck_id'], 'Value': reading['load'], 'Unit': 'None'} for reading in readings]
+    for i in range(0, len(metrics), CLOUDWATCH_BATCH_SIZE):
+        cloudwatch.put_metric_data(Namespace=METRICS_NAMESPACE, MetricData=metrics[i:i + CLOUDWATCH_BATCH_SIZE])
+
+
+# Lambda handler, invoked by the IoT rule with one city batch
+def handler(event, context):
+    readings = event.get("readings", [])
+    print(f"SPLITBATCH: {len(readings)} readings for {event.get('city')} part {event.get('part', 0)}")
+    write_to_firehose(readings)
+    write_to_cloudwatch(readings)
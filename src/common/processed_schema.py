@@ -0,0 +1,130 @@
+import datetime
+import os
+from dataclasses import dataclass
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Parquet layout of processed/ readings, shared by data_transform and parquet_compact.
+# Reading coordinates are generated to 6 decimal places, which float32 cannot hold at UK latitudes, so only the
+# postcode and outcode centroids are narrowed. Repeated strings are dictionary encoded.
+
+STRING = pa.dictionary(pa.int32(), pa.string())
+
+SCHEMA = pa.schema([
+    ("timestamp", pa.timestamp("ms")),
+    ("truck_id", STRING),
+    ("lat", pa.float64()),
+    ("lon", pa.float64()),
+    ("load", pa.float64()),
+    ("postcode", STRING),
+    ("postcode_lat", pa.float32()),
+    ("postcode_lon", pa.float32()),
+    ("outcode", STRING),
+    ("outcode_lat", pa.float32()),
+    ("outcode_lon", pa.float32()),
+])
+
+# Files do not store the Arrow schema, these are read back as dictionaries
+DICTIONARY_COLUMNS = [field.name for field in SCHEMA if pa.types.is_dictionary(field.type)]
+
+# data_transform leaves a marker per output file under TOUCHED_PREFIX/<partition>/, parquet_compact only visits
+# partitions with markers
+TOUCHED_PREFIX = "checkpoints/compaction/touched/"
+
+PARQUET_COMPRESSION = os.environ.get('PARQUET_COMPRESSION', 'zstd')
+PARQUET_ROW_GROUP_SIZE = int(os.environ.get('PARQUET_ROW_GROUP_SIZE', 1000000))
+
+
+def to_array(values, type):
+    if pa.types.is_dictionary(type):
+        return pa.array(values, type=type.value_type).dictionary_encode()
+    return pa.array(values, type=type)
+
+
+def to_batch(columns):
+    return pa.RecordBatch.from_arrays([to_array(columns[field.name], field.type) for field in SCHEMA], schema=SCHEMA)
+
+
+def conform(table):
+    # Files written before the schema was fixed hold float64 and plain strings, cast them on read
+    return table.select(SCHEMA.names).cast(SCHEMA)
+
+
+def decode(column):
+    return column.cast(column.type.value_type) if pa.types.is_dictionary(column.type) else column
+
+
+def sort_table(table, keys):
+    # Arrow cannot sort dictionary columns, the order is taken from their decoded values
+    order = pc.sort_indices(pa.table({key : decode(table.column(key)) for key in keys}),
+        sort_keys=[(key, "ascending") for key in keys])
+    return table.take(order)
+
+
+def city_of(truck_id):
+    # Truck ids are the first three characters of the city name followed by a number, synthetic city names end in
+    # digits so the prefix is taken by length
+    return truck_id[:3].lower() or "unknown"
+
+
+def partition_of(day, city):
+    date = datetime.date(1970, 1, 1) + datetime.timedelta(days=int(day))
+    return f"year={date.year}/month={date.month:02d}/day={date.day:02d}/city={city}"
+
+
+def parse_partition(key):
+    return dict(part.split("=", 1) for part in key.split("/") if "=" in part)
+
+
+def split_partitions(batch):
+    # Groups rows by the day of the reading and the city of the truck, yields (partition, rows)
+    days = batch.column("timestamp").cast(pa.int64()).to_numpy() // 86400000
+    truck_ids = batch.column("truck_id")
+    cities, city_index = np.unique([city_of(truck_id) for truck_id in truck_ids.dictionary.to_pylist()],
+        return_inverse=True)
+    groups = (days - days.min()) * len(cities) + city_index[truck_ids.indices.to_numpy()]
+    order = np.argsort(groups, kind="stable")
+    starts = np.flatnonzero(np.diff(groups[order], prepend=-1))
+    for rows in np.split(order, starts[1:]):
+        group = groups[rows[0]]
+        yield partition_of(days.min() + group // len(cities), cities[group % len(cities)]), rows
+
+
+@dataclass
+class RowGroupWriter:
+    where : object
+    rows : int = 0
+    row_group_size : int = None
+    # Columns the rows are written in order of, recorded in the file metadata
+    sort_keys : tuple = ()
+
+    def __post_init__(self):
+        self.row_group_size = self.row_group_size or PARQUET_ROW_GROUP_SIZE
+        sorting_columns = pq.SortingColumn.from_ordering(SCHEMA, [(key, "ascending") for key in self.sort_keys]) \
+            if self.sort_keys else None
+        # Column statistics and the page index let readers skip row groups and pages that cannot match a filter. The
+        # Arrow schema is not stored, Arrow does not prune on dictionary typed columns, readers conform on read.
+        self.writer = pq.ParquetWriter(self.where, SCHEMA, compression=PARQUET_COMPRESSION, write_statistics=True,
+            write_page_index=True, sorting_columns=sorting_columns, store_schema=False)
+        self.pending = []
+        self.pending_rows = 0
+
+    def write(self, batch):
+        # Batches are buffered until a full row group so the row group size does not depend on the batch size
+        self.pending.append(batch)
+        self.pending_rows += batch.num_rows
+        self.rows += batch.num_rows
+        if self.pending_rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.writer.write_table(pa.Table.from_batches(self.pending, schema=SCHEMA), row_group_size=self.row_group_size)
+        self.pending = []
+        self.pending_rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
@@ -0,0 +1,101 @@
+import json
+import struct
+import zlib
+import numpy as np
+
+# Compact batch encoding for truck readings, shared by data_generator, historical_writer and data_transform.
+# A message is one or more frames back to back, each frame is
+#   magic (3 bytes) | version (uint8) | header length (uint32 LE) | JSON header | compressed column blocks
+# The header lists the reading count and the name, dtype and compressed size of each block in order.
+
+MAGIC = b"WCB"
+VERSION = 1
+CONTENT_TYPE = "application/x-wastecollection-batch;v=1"
+PREFIX = struct.Struct("<3sBI")
+COORDINATE_SCALE = 1000000
+
+
+def encode_frame(timestamps, truck_ids, lat, lon, load, level=6):
+    truck_ids = np.asarray(truck_ids)
+    if truck_ids.dtype.kind == "S":
+        truck_ids = truck_ids.astype(str)
+    dictionary, truck_index = np.unique(truck_ids, return_inverse=True)
+
+    # Coordinates are generated to 6 decimal places so they are stored exactly as scaled integers
+    columns = [
+        ("truck_ids", "utf-8", "\n".join(dictionary.tolist()).encode("utf-8")),
+        ("timestamp", "<i8", np.broadcast_to(np.asarray(timestamps, dtype="<i8"), truck_ids.shape).tobytes()),
+        ("truck_index", "<u4", truck_index.astype("<u4").tobytes()),
+        ("lat", "<i4", np.rint(np.asarray(lat) * COORDINATE_SCALE).astype("<i4").tobytes()),
+        ("lon", "<i4", np.rint(np.asarray(lon) * COORDINATE_SCALE).astype("<i4").tobytes()),
+        ("load", "<f8", np.asarray(load, dtype="<f8").tobytes()),
+    ]
+
+    blocks = [zlib.compress(data, level) for _, _, data in columns]
+    header = json.dumps({
+        "count" : len(truck_ids),
+        "codec" : "zlib",
+        "columns" : [{"name" : name, "dtype" : dtype, "bytes" : len(block)}
+            for (name, dtype, _), block in zip(columns, blocks)]
+    }, separators=(",", ":")).encode("utf-8")
+    return PREFIX.pack(MAGIC, VERSION, len(header)) + header + b"".join(blocks)
+
+
+def is_wire_format(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError(f"Truncated frame, expected {size} bytes and got {len(data)}")
+    return data
+
+
+def read_header(stream):
+    prefix = stream.read(PREFIX.size)
+    if not prefix:
+        return None
+    if len(prefix) != PREFIX.size:
+        raise ValueError("Truncated frame prefix")
+    magic, version, header_length = PREFIX.unpack(prefix)
+    if magic != MAGIC:
+        raise ValueError(f"Not a wire format frame, found {magic!r}")
+    if version != VERSION:
+        raise ValueError(f"Unsupported wire format version {version}")
+    return json.loads(read_exact(stream, header_length))
+
+
+def decode_columns(header, stream):
+    columns = {}
+    for column in header["columns"]:
+        data = zlib.decompress(read_exact(stream, column["bytes"]))
+        if column["dtype"] == "utf-8":
+            columns[column["name"]] = np.array(data.decode("utf-8").split("\n")) if data else np.array([], dtype=str)
+        else:
+            columns[column["name"]] = np.frombuffer(data, dtype=column["dtype"])
+    return {
+        "timestamp" : columns["timestamp"],
+        "truck_id" : columns["truck_ids"][columns["truck_index"]],
+        "lat" : columns["lat"] / COORDINATE_SCALE,
+        "lon" : columns["lon"] / COORDINATE_SCALE,
+        "load" : columns["load"],
+    }
+
+
+def iter_frames(stream):
+    # Reads one frame at a time from a file like object, memory is bounded by the largest frame
+    while True:
+        header = read_header(stream)
+        if header is None:
+            return
+        yield decode_columns(header, stream)
+
+
+def iter_headers(stream):
+    while True:
+        header = read_header(stream)
+        if header is None:
+            return
+        stream.seek(sum(column["bytes"] for column in header["columns"]), 1)
+        yield header
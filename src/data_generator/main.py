@@ -1,44 +1,92 @@
 from dataclasses import dataclass, field
-from random import uniform, randint
-from decimal import Decimal
-from datetime import datetime, timedelta, time
+from datetime import date, datetime, timedelta, time
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import asyncio
+import base64
 import boto3
+import uuid
+import hashlib
+import heapq
 import json
+import numpy as np
 import secrets
 import paho.mqtt.client as paho
 import os
+import signal
 import ssl
-from pprint import pprint
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import BoundedSemaphore, Event, Lock
+from time import perf_counter, sleep
+
+import wire_format
 
 TRUCK_QUANTITY = {"glasgow" : 41, "edinburgh": 32, "dundee" : 20, "aberdeen" : 20, "inverness" : 20}
 
-@dataclass
-class Waste:
+# MQTT broker, override endpoint/port/TLS to test against a local broker
+IOT_ENDPOINT = os.environ.get('IOT_ENDPOINT', "a4nbpn9s9e1mr-ats.iot.eu-west-1.amazonaws.com")
+IOT_PORT = int(os.environ.get('IOT_PORT', 8883))
+IOT_TLS = os.environ.get('IOT_TLS', 'true').lower() == 'true'
+PATH_TO_CERT = "/tmp/1e6a88bcb8-certificate.pem.crt"
+PATH_TO_KEY = "/tmp/1e6a88bcb8-private.pem.key"
+PATH_TO_ROOT = "/tmp/AmazonRootCA1.pem"
+
+# One long lived connection per container, reused across warm invocations
+MQTT_PUBLISHER = None
+
+# Live publishing engine, async publishes at QoS 1 within an adaptive in flight window
+LIVE_PUBLISHER = os.environ.get('LIVE_PUBLISHER', 'async')
+MQTT_INFLIGHT_WINDOW = int(os.environ.get('MQTT_INFLIGHT_WINDOW', 100))
+MQTT_ACK_TIMEOUT = float(os.environ.get('MQTT_ACK_TIMEOUT', 5.0))
+MQTT_ACK_LATENCY_TARGET = float(os.environ.get('MQTT_ACK_LATENCY_TARGET', 1.0))
+MQTT_MAX_RETRIES = 3
+METRICS_NAMESPACE = "WasteCollectionGenerator"
+ASYNC_PUBLISHER = None
+
+# Publish one message per city per tick instead of one per truck, split back out by the batch splitter
+LIVE_BATCHING = os.environ.get('LIVE_BATCHING', 'false').lower() == 'true'
+# Keeps each batch inside the 128 KB IoT message limit
+BATCH_MAX_READINGS = 1000
+
+# Per container state, built on the first invocation and reused while the container is warm
+AWS_CLIENTS = {}
+FLEET = None
+CERTS_READY = False
+INIT_SECONDS = {}
+
+# Minute slots simulated per vectorised draw in historical mode
+SLOT_BLOCK_SIZE = 60
 
-    def get_waste(self):
-        return float(format(Decimal(uniform(0.1, 15)), '.2f'))
+# SQS batch limits and the number of concurrent send_message_batch calls
+SQS_BATCH_SIZE = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+SQS_MAX_IN_FLIGHT = int(os.environ.get('SQS_MAX_IN_FLIGHT', 8))
+SQS_MAX_RETRIES = 5
 
+# Historical slots packed into one compact SQS message, base64 leaves room for ~190 KB of frames
+SLOTS_PER_MESSAGE = 60
+MAX_MESSAGE_FRAME_BYTES = 190 * 1024
+
+# Historical backfills are split into shards of whole days, progress is saved per shard
+SHARD_DAYS = int(os.environ.get('SHARD_DAYS', 7))
+CHECKPOINT_BUCKET = os.environ.get('CHECKPOINT_BUCKET')
+CHECKPOINT_PREFIX = "checkpoints/historical/"
+# Stop taking new shards when less than this is left of the Lambda timeout
+TIMEOUT_MARGIN_MS = 120 * 1000
 
 @dataclass
 class TruckInventory:
     city_name : str
-    inventory : dict = field(default_factory=dict)
+    volume : int = None
 
     def __post_init__(self):
-        self.inventory = self.get_inventory()
-
-    def get_inventory(self):
-        inventories = {}
-        for city, volume in TRUCK_QUANTITY.items():
-            id_list = []
-            unique_id = 0
-            for _ in range(0, volume):
-                unique_id += 1
-                id_list.append({"id" : city[0:3] + str(unique_id).zfill(4)})
-            inventories.update({city : id_list})
+        if self.volume is None:
+            self.volume = TRUCK_QUANTITY[self.city_name]
 
-        return inventories[self.city_name]
+    def get_ids(self):
+        # Byte strings keep 100k+ truck inventories to a few bytes per truck
+        numbers = np.char.zfill(np.arange(1, self.volume + 1).astype(str), 4)
+        return np.char.add(self.city_name[0:3], numbers).astype(bytes)
 
 
 @dataclass
@@ -47,7 +95,8 @@ class City:
     boundary : dict = field(default_factory=dict)
 
     def __post_init__(self):
-        self.boundary = self.get_boundary()
+        if not self.boundary:
+            self.boundary = self.get_boundary()
 
     def get_boundary(self):
         boundaries =  {"glasgow": {"lat": {"min" : 55.800818, "max" : 55.905653},
@@ -62,22 +111,63 @@ class City:
             "lon": {"min" : -3.049765 , "max" : -2.974970}}}
         return boundaries[self.name]
 
-    def get_random_boundary_position(self):
-        return [round(uniform(self.boundary["lat"]["min"], self.boundary["lat"]["max"]),6),
-                round(uniform(self.boundary["lon"]["min"], self.boundary["lon"]["max"]),6)]
+
+def get_synthetic_city(index):
+    # Three character names keep truck id prefixes unique, boxes are laid out on a grid over Scotland
+    name = "x" + np.base_repr(index, 36).lower().zfill(2)
+    lat_min = 55.0 + (index % 20) * 0.15
+    lon_min = -5.0 + (index // 20 % 20) * 0.15
+    return City(name, {"lat": {"min" : lat_min, "max" : lat_min + 0.05},
+        "lon": {"min" : lon_min, "max" : lon_min + 0.1}})
 
 
 @dataclass
-class BinTruck:
-    id : str
-    boundary : City
-    position : list = field(default_factory=list)
+class Fleet:
+    cities : list
+    rng : np.random.Generator = field(default_factory=np.random.default_rng)
+    quantities : dict = field(default_factory=lambda: dict(TRUCK_QUANTITY))
 
     def __post_init__(self):
-        self.position = self.boundary.get_random_boundary_position()
+        inventories = [TruckInventory(city.name, self.quantities[city.name]) for city in self.cities]
+        self.ids = np.concatenate([inventory.get_ids() for inventory in inventories])
+        self.city_index = np.repeat(np.arange(len(self.cities), dtype=np.int16),
+            [inventory.volume for inventory in inventories])
+
+        # Boundaries are held per city and gathered per truck at draw time
+        self.lat_min = np.array([city.boundary["lat"]["min"] for city in self.cities])
+        self.lat_max = np.array([city.boundary["lat"]["max"] for city in self.cities])
+        self.lon_min = np.array([city.boundary["lon"]["min"] for city in self.cities])
+        self.lon_max = np.array([city.boundary["lon"]["max"] for city in self.cities])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_city_trucks(self, city_name):
+        names = [city.name for city in self.cities]
+        return np.flatnonzero(self.city_index == names.index(city_name))
 
-    def move_down_road(self):
-        self.position = self.boundary.get_random_boundary_position()
+    def move_down_road(self, slots=1, trucks=None):
+        city_index = self.city_index if trucks is None else self.city_index[trucks]
+        shape = (slots, len(city_index))
+        lat = np.round(self.rng.uniform(self.lat_min[city_index], self.lat_max[city_index], shape), 6)
+        lon = np.round(self.rng.uniform(self.lon_min[city_index], self.lon_max[city_index], shape), 6)
+        return lat, lon
+
+    def get_waste(self, slots=1, trucks=None):
+        count = len(self) if trucks is None else len(trucks)
+        return np.round(self.rng.uniform(0.1, 15, (slots, count)), 2)
+
+    def simulate(self, slots=1, weighting=1.0, trucks=None):
+        lat, lon = self.move_down_road(slots, trucks)
+        load = self.get_waste(slots, trucks) * weighting
+        return lat, lon, load
+
+    def payloads(self, timestamp, lat, lon, load, trucks=None):
+        ids = self.ids if trucks is None else self.ids[trucks]
+        timestamps = np.broadcast_to(timestamp, ids.shape).tolist()
+        return [{"timestamp" : truck_timestamp, "truck_id" : truck_id, "lat" : truck_lat, "lon" : truck_lon, "load" : truck_load}
+            for truck_timestamp, truck_id, truck_lat, truck_lon, truck_load
+            in zip(timestamps, ids.astype(str).tolist(), lat.tolist(), lon.tolist(), load.tolist())]
 
 
 @dataclass
@@ -98,62 +188,668 @@ class TimeSlot:
 
 
 @dataclass
-class MqttMessage:
-    topic : str = "/"
-    payload : dict = field(default_factory=dict)
-
-    def send(self, truck, time_slot, waste, weighting):
-        self.topic = f"waste/household/{truck.id}/collection"
-        self.payload = {}
-        self.payload.update({"timestamp" : time_slot.time_to_ms(time_slot.time_slot)})
-        self.payload.update({"truck_id" : truck.id})
-        self.payload.update({"lat" : truck.position[0]})
-        self.payload.update({"lon" : truck.position[1]})
-        self.payload.update({"load" : waste.get_waste() * weighting})
-        self.send_to_aws_iot()
-
-    def send_to_aws_iot(self):
-        print("MQTTSTATUS: Settings MQTT variables")
-        ENDPOINT = "a4nbpn9s9e1mr-ats.iot.eu-west-1.amazonaws.com"
-        CLIENT_ID = "WasteCollectionIngest-" + secrets.token_hex(6)
-        PATH_TO_CERT = "/tmp/1e6a88bcb8-certificate.pem.crt"
-        PATH_TO_KEY = "/tmp/1e6a88bcb8-private.pem.key"
-        PATH_TO_ROOT = "/tmp/AmazonRootCA1.pem"
-        MESSAGE = self.payload
-        TOPIC = self.topic
-
-        def on_message(clients, userdata, message):
-                print("message received " ,str(message.payload.decode("utf-8")))
-                print("message topic=",message.topic)
-                print("message qos=",message.qos)
-                print("message retain flag=",message.retain)
-
-        def on_log(client,userdata,level,buff):
-            print(buff)
+class MqttPublisher:
+    endpoint : str = IOT_ENDPOINT
+    port : int = IOT_PORT
+    use_tls : bool = IOT_TLS
+    qos : int = 0
+    keepalive : int = 60
+    connect_timeout : float = 10.0
+    publish_timeout : float = 10.0
+    client_id : str = field(default_factory=lambda: "WasteCollectionIngest-" + secrets.token_hex(6))
+
+    def __post_init__(self):
+        self.client = None
+        self.connected = Event()
+        self.pending = []
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            print(f"MQTTSTATUS: Connected to {self.endpoint}:{self.port} as {self.client_id}")
+            self.connected.set()
+        else:
+            print(f"MQTTSTATUS: Connection refused, {paho.connack_string(rc)}")
+
+    def on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+        print(f"MQTTSTATUS: Disconnected, {paho.error_string(rc)}")
+
+    def connect(self):
+        # Reuse the container's connection, the network loop reconnects after a freeze
+        if self.client is not None:
+            if not self.connected.wait(self.connect_timeout):
+                raise ConnectionError(f"MQTT connection to {self.endpoint} was not re-established")
+            return
 
         print("MQTTSTATUS: Instantiate MQTT Client")
-        mqttc = paho.Client(CLIENT_ID)
-        mqttc.tls_set(PATH_TO_ROOT,
-            certfile=PATH_TO_CERT,
-            keyfile=PATH_TO_KEY,
-            cert_reqs=ssl.CERT_REQUIRED,
-            tls_version=ssl.PROTOCOL_TLSv1_2,
-            ciphers=None
-            )
-
-
-        print(TOPIC)
-        print(json.dumps(MESSAGE))
-        mqttc.on_message = on_message
-        mqttc.on_log = on_log
-
-        print("MQTTSTATUS: Connecting to MQTT Broker")
-        mqttc.connect(ENDPOINT, 8883, keepalive=10)
-        mqttc.loop_start()
-        mqttc.subscribe(TOPIC)
-        mqttc.publish(TOPIC, json.dumps(MESSAGE), qos=0)
-        sleep(0.4)
-        mqttc.loop_stop()
+        self.client = paho.Client(self.client_id)
+        try:
+            if self.use_tls:
+                init_certs()
+                self.client.tls_set(PATH_TO_ROOT,
+                    certfile=PATH_TO_CERT,
+                    keyfile=PATH_TO_KEY,
+                    cert_reqs=ssl.CERT_REQUIRED,
+                    tls_version=ssl.PROTOCOL_TLSv1_2,
+                    ciphers=None
+                    )
+            self.client.on_connect = self.on_connect
+            self.client.on_disconnect = self.on_disconnect
+
+            print("MQTTSTATUS: Connecting to MQTT Broker")
+            self.client.connect(self.endpoint, self.port, keepalive=self.keepalive)
+        except Exception:
+            # Without a network loop the client would never reconnect, the next call starts again
+            self.disconnect()
+            raise
+        self.client.loop_start()
+        if not self.connected.wait(self.connect_timeout):
+            self.disconnect()
+            raise ConnectionError(f"MQTT connection to {self.endpoint} timed out")
+
+    def publish(self, topic, payload):
+        self.connect()
+        message_info = self.client.publish(topic, json.dumps(payload), qos=self.qos)
+        self.pending.append(message_info)
+        return message_info
+
+    def flush(self):
+        published = 0
+        failed = 0
+        for message_info in self.pending:
+            try:
+                message_info.wait_for_publish(self.publish_timeout)
+            except (ValueError, RuntimeError) as ex:
+                print(f"MQTTSTATUS: Publish {message_info.mid} failed, {ex}")
+            if message_info.is_published():
+                published += 1
+            else:
+                failed += 1
+        self.pending = []
+        print(f"MQTTSTATUS: Flushed {published} messages, {failed} failed")
+        return published, failed
+
+    def disconnect(self):
+        if self.client is not None:
+            self.client.loop_stop()
+            self.client.disconnect()
+        self.client = None
+        self.connected.clear()
+
+
+@dataclass
+class PublishStats:
+
+    def __post_init__(self):
+        self.start = perf_counter()
+        self.acked_at = []
+        self.latencies = []
+        self.retries = 0
+        self.dropped = 0
+
+    def record_ack(self, sent_at, acked_at):
+        self.acked_at.append(acked_at - self.start)
+        self.latencies.append(acked_at - sent_at)
+
+    def summary(self):
+        elapsed = perf_counter() - self.start
+        per_second = np.bincount(np.array(self.acked_at, dtype=int)) if self.acked_at else np.zeros(1)
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        return {"Published" : len(self.acked_at), "Retries" : self.retries, "Dropped" : self.dropped,
+            "PublishRate" : round(len(self.acked_at) / elapsed, 1), "PeakPublishRate" : int(per_second.max()),
+            "AckLatencyP50" : round(p50, 2), "AckLatencyP95" : round(p95, 2), "AckLatencyP99" : round(p99, 2)}
+
+    def export(self):
+        # CloudWatch embedded metric format, picked up from the Lambda log without API calls
+        summary = self.summary()
+        units = {"PublishRate" : "Count/Second", "PeakPublishRate" : "Count/Second", "AckLatencyP50" : "Milliseconds",
+            "AckLatencyP95" : "Milliseconds", "AckLatencyP99" : "Milliseconds"}
+        print(json.dumps({"_aws" : {"Timestamp" : int(datetime.now().timestamp() * 1000),
+            "CloudWatchMetrics" : [{"Namespace" : METRICS_NAMESPACE, "Dimensions" : [[]],
+                "Metrics" : [{"Name" : name, "Unit" : units.get(name, "Count")} for name in summary]}]},
+            **summary}))
+        return summary
+
+
+@dataclass
+class AsyncMqttPublisher:
+    publisher : MqttPublisher
+    max_window : int = MQTT_INFLIGHT_WINDOW
+    min_window : int = 1
+    ack_timeout : float = MQTT_ACK_TIMEOUT
+    latency_target : float = MQTT_ACK_LATENCY_TARGET
+    max_retries : int = MQTT_MAX_RETRIES
+
+    def __post_init__(self):
+        self.window = float(self.max_window)
+        self.in_flight = 0
+        self.acks = {}
+        self.loop = None
+
+    def on_publish(self, client, userdata, mid):
+        # Called from the paho network thread
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self.acknowledge, mid, perf_counter())
+
+    def acknowledge(self, mid, acked_at):
+        future = self.acks.pop(mid, None)
+        if future is not None and not future.done():
+            future.set_result(acked_at)
+
+    async def acquire(self):
+        async with self.window_changed:
+            await self.window_changed.wait_for(lambda: self.in_flight < int(self.window))
+            self.in_flight += 1
+
+    async def release(self, congested):
+        # Additive increase per ack, halve the window on slow or missing acks
+        async with self.window_changed:
+            self.in_flight -= 1
+            if congested:
+                self.window = max(self.min_window, self.window / 2)
+            else:
+                self.window = min(self.max_window, self.window + 1 / self.window)
+            self.window_changed.notify_all()
+
+    async def publish_one(self, topic, message):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats.retries += 1
+            await self.acquire()
+            congested = True
+            try:
+                sent_at = perf_counter()
+                message_info = self.publisher.client.publish(topic, message, qos=1)
+                # While disconnected paho keeps QoS 1 messages and sends them on reconnect, so only wait for the ack
+                queued = message_info.rc == paho.MQTT_ERR_NO_CONN
+                if message_info.rc != paho.MQTT_ERR_SUCCESS and not queued:
+                    print(f"MQTTSTATUS: Publish rejected, {paho.error_string(message_info.rc)}")
+                    await asyncio.sleep(min(0.1 * 2 ** attempt, 2))
+                    continue
+                future = self.loop.create_future()
+                self.acks[message_info.mid] = future
+                timeout = self.ack_timeout + (self.publisher.connect_timeout if queued else 0)
+                try:
+                    acked_at = await asyncio.wait_for(future, timeout)
+                except asyncio.TimeoutError:
+                    self.acks.pop(message_info.mid, None)
+                    continue
+                congested = acked_at - sent_at > self.latency_target
+                self.stats.record_ack(sent_at, acked_at)
+                return True
+            finally:
+                await self.release(congested)
+
+        self.stats.dropped += 1
+        return False
+
+    async def publish_all(self, messages):
+        self.loop = asyncio.get_running_loop()
+        self.window_changed = asyncio.Condition()
+        self.stats = PublishStats()
+        self.publisher.connect()
+        self.publisher.client.max_inflight_messages_set(self.max_window)
+        self.publisher.client.on_publish = self.on_publish
+        try:
+            await asyncio.gather(*(self.publish_one(topic, json.dumps(payload)) for topic, payload in messages))
+        finally:
+            self.loop = None
+        return self.stats
+
+
+def get_client(service):
+    if service not in AWS_CLIENTS:
+        AWS_CLIENTS[service] = boto3.client(service)
+    return AWS_CLIENTS[service]
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def init_certs():
+    global CERTS_READY
+    if CERTS_READY:
+        print(f"INIT: Reused certificates, saved {INIT_SECONDS['certs']:.3f}s")
+        return
+
+    start = perf_counter()
+    BUCKET_NAME = os.environ.get('KEYS_BUCKET', 'no-bucket')
+    OBJECTS_ = ["1e6a88bcb8-certificate.pem.crt",
+        "1e6a88bcb8-private.pem.key",
+        "AmazonRootCA1.pem"
+    ]
+
+    s3 = get_client('s3')
+    for object_ in OBJECTS_:
+        try:
+            # Certificates are uploaded in one part so the ETag is the file's MD5
+            etag = s3.head_object(Bucket=BUCKET_NAME, Key=object_)['ETag'].strip('"')
+            if os.path.isfile("/tmp/" + object_) and file_md5("/tmp/" + object_) == etag:
+                print(f"COPYFILE: {object_} cached in /tmp")
+            else:
+                s3.download_file(BUCKET_NAME, object_, "/tmp/" + object_)
+        except Exception:
+            print("COPYFILE: Could not copy file from S3")
+
+
+        if os.path.isfile("/tmp/" + object_):
+            print(f"CHECKFILE: {object_} exists")
+        else:
+            print(f"CHECKFILE: {object_} doesnt exist")
+
+    CERTS_READY = all(os.path.isfile("/tmp/" + object_) for object_ in OBJECTS_)
+    INIT_SECONDS['certs'] = perf_counter() - start
+
+
+def get_messages(payloads):
+    return [(f"waste/household/{payload['truck_id']}/collection", payload) for payload in payloads]
+
+
+def get_mqtt_publisher():
+    global MQTT_PUBLISHER
+    if MQTT_PUBLISHER is None:
+        MQTT_PUBLISHER = MqttPublisher()
+    return MQTT_PUBLISHER
+
+
+def get_async_publisher():
+    global ASYNC_PUBLISHER
+    if ASYNC_PUBLISHER is None:
+        ASYNC_PUBLISHER = AsyncMqttPublisher(get_mqtt_publisher())
+    return ASYNC_PUBLISHER
+
+
+@dataclass
+class Shard:
+    index : int
+    first_day : date
+    last_day : date
+
+    def time_slots(self, begin_time, end_time):
+        # Resume from the previous day's close so the shard yields the same slots as one long run
+        shard_begin = datetime.combine(self.first_day - timedelta(days=1), TimeSlot.work_day_end)
+        time_slot = TimeSlot(max(begin_time, shard_begin))
+        while end_time - timedelta(minutes=1) > time_slot.time_slot:
+            time_slot.increment_time_slot()
+            if time_slot.time_slot.date() >= self.last_day:
+                break
+            yield time_slot.time_slot
+
+    def get_rng(self, seed):
+        # Seeded from the shard's first day so a shard reproduces regardless of the run it is part of
+        return np.random.default_rng([seed, self.first_day.toordinal()])
+
+
+@dataclass
+class Checkpoint:
+    run_id : str
+    bucket : str = CHECKPOINT_BUCKET
+
+    def __post_init__(self):
+        self.prefix = f"{CHECKPOINT_PREFIX}{self.run_id}/"
+        if self.bucket is None:
+            print("CHECKPOINT: No CHECKPOINT_BUCKET set, progress will not be saved")
+        else:
+            self.s3 = get_client('s3')
+
+    def completed_shards(self):
+        completed = set()
+        if self.bucket is None:
+            return completed
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + "shard-"):
+            for object_ in page.get('Contents', []):
+                completed.add(int(object_['Key'][len(self.prefix + "shard-"):].split(".")[0]))
+        print(f"CHECKPOINT: {len(completed)} shards already complete for run {self.run_id}")
+        return completed
+
+    def save(self, shard, stats):
+        if self.bucket is None:
+            return
+        key = f"{self.prefix}shard-{shard.index:05d}.json"
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=json.dumps(stats))
+        print(f"CHECKPOINT: Saved s3://{self.bucket}/{key}")
+
+
+@dataclass
+class SqsBatchSender:
+    queue_url : str
+    max_in_flight : int = SQS_MAX_IN_FLIGHT
+    max_retries : int = SQS_MAX_RETRIES
+    delay_seconds : int = 10
+
+    def __post_init__(self):
+        # boto3 clients are thread safe, one is shared by every in flight batch
+        self.client = get_client('sqs')
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        self.in_flight = BoundedSemaphore(self.max_in_flight)
+        self.lock = Lock()
+        self.futures = []
+        self.entries = []
+        self.entries_bytes = 0
+        self.sent = 0
+        self.failed = 0
+
+    def send(self, time_slot, payloads, content_type=None):
+        entry = {
+            'Id': str(len(self.entries)),
+            'MessageBody': payloads,
+            'DelaySeconds': self.delay_seconds,
+            'MessageAttributes': {
+                'timeslot': {
+                    'DataType': 'String',
+                    'StringValue': time_slot.isoformat()
+                }
+            }
+        }
+        entry_bytes = len(payloads.encode("utf-8")) + len("timeslot") + len("String") + len(time_slot.isoformat())
+        if content_type is not None:
+            entry['MessageAttributes']['format'] = {'DataType': 'String', 'StringValue': content_type}
+            entry_bytes += len("format") + len("String") + len(content_type)
+        if self.entries and self.entries_bytes + entry_bytes > SQS_MAX_BATCH_BYTES:
+            self.submit()
+            entry['Id'] = "0"
+        self.entries.append(entry)
+        self.entries_bytes += entry_bytes
+        if len(self.entries) == SQS_BATCH_SIZE:
+            self.submit()
+
+    def submit(self):
+        # Blocks once max_in_flight batches are outstanding
+        self.in_flight.acquire()
+        future = self.executor.submit(self.send_batch, self.entries)
+        future.add_done_callback(lambda _: self.in_flight.release())
+        self.futures.append(future)
+        self.entries = []
+        self.entries_bytes = 0
+
+    def send_batch(self, entries):
+        attempt = 0
+        while entries:
+            result = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            sent = len(result.get('Successful', []))
+            retry_ids = set()
+            failed = 0
+            for failure in result.get('Failed', []):
+                if failure['SenderFault']:
+                    print(f"SENTSQS: Message {failure['Id']} rejected, {failure['Code']} {failure.get('Message', '')}")
+                    failed += 1
+                else:
+                    retry_ids.add(failure['Id'])
+
+            entries = [entry for entry in entries if entry['Id'] in retry_ids]
+            attempt += 1
+            if entries and attempt > self.max_retries:
+                print(f"SENTSQS: Giving up on {len(entries)} messages after {self.max_retries} retries")
+                failed += len(entries)
+                entries = []
+            elif entries:
+                sleep(min(0.1 * 2 ** attempt, 5))
+
+            with self.lock:
+                self.sent += sent
+                self.failed += failed
+
+    def flush(self):
+        if self.entries:
+            self.submit()
+        wait(self.futures)
+        for future in self.futures:
+            future.result()
+        self.futures = []
+        # Counts are per flush, so each shard reports only its own messages
+        with self.lock:
+            sent, failed = self.sent, self.failed
+            self.sent = self.failed = 0
+        print(f"SENTSQS: {sent} messages sent, {failed} failed")
+        return sent, failed
+
+
+@dataclass
+class BatchMessage:
+    sender : SqsBatchSender
+    max_slots : int = SLOTS_PER_MESSAGE
+    max_bytes : int = MAX_MESSAGE_FRAME_BYTES
+
+    def __post_init__(self):
+        self.time_slot = None
+        self.frames = []
+        self.frames_bytes = 0
+
+    def add(self, time_slot, frame):
+        # historical_writer files a message under its first slot's hour, so messages never span hours
+        if self.frames and (time_slot.replace(minute=0) != self.time_slot.replace(minute=0)
+                or len(self.frames) == self.max_slots or self.frames_bytes + len(frame) > self.max_bytes):
+            self.flush()
+        if not self.frames:
+            self.time_slot = time_slot
+        self.frames.append(frame)
+        self.frames_bytes += len(frame)
+
+    def flush(self):
+        if self.frames:
+            body = base64.b64encode(b"".join(self.frames)).decode("ascii")
+            self.sender.send(self.time_slot, body, wire_format.CONTENT_TYPE)
+        self.frames = []
+        self.frames_bytes = 0
+
+
+@dataclass
+class TrafficProfile:
+    rate : float = 1.0
+    rush_hours : list = field(default_factory=list)
+    backlogs : list = field(default_factory=list)
+
+    def __post_init__(self):
+        # "07:00-09:00x3" multiplies the reading rate between 07:00 and 09:00 by three
+        self.rush_hours = [self.parse_rush_hour(rush_hour) for rush_hour in self.rush_hours]
+        # "dundee:60@12:00" replays 60 minutes of dundee readings in the 12:00 slot
+        self.backlogs = [self.parse_backlog(backlog) for backlog in self.backlogs]
+
+    def parse_rush_hour(self, rush_hour):
+        window, multiplier = rush_hour.split("x")
+        start, end = window.split("-")
+        return time.fromisoformat(start), time.fromisoformat(end), float(multiplier)
+
+    def parse_backlog(self, backlog):
+        city_name, replay = backlog.split(":", 1)
+        minutes, at = replay.split("@")
+        return city_name, int(minutes), time.fromisoformat(at)
+
+    def get_rate(self, time_slot):
+        rate = self.rate
+        for start, end, multiplier in self.rush_hours:
+            if start <= time_slot.time() < end:
+                rate *= multiplier
+        return rate
+
+    def get_backlogs(self, time_slot):
+        return [(city_name, minutes) for city_name, minutes, at in self.backlogs if at == time_slot.time()]
+
+
+@dataclass
+class LocalSink:
+    output_dir : str
+
+    def __post_init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.readings = 0
+
+    def write(self, time_slot, payloads):
+        # Mirrors the raw/ layout and naming used by Firehose and historical_writer
+        ts_str = time_slot.strftime("%Y-%m-%d-%H-%M-%S")
+        file_dir = os.path.join(self.output_dir, "raw", time_slot.strftime("%Y/%m/%d/%H"))
+        os.makedirs(file_dir, exist_ok=True)
+        body = "".join(json.dumps(payload) + "," for payload in payloads).encode("utf-8")
+        with open(os.path.join(file_dir, f"WasteCollectionDeliveryStream-1-{ts_str}-{uuid.uuid4()}"), "wb") as f:
+            f.write(body)
+        self.files += 1
+        self.bytes += len(body)
+        self.readings += len(payloads)
+        return len(body)
+
+
+@dataclass
+class LoadTest:
+    fleet : Fleet
+    profile : TrafficProfile
+    sink : LocalSink
+    begin_time : datetime
+    end_time : datetime
+    weighting : float = 1.0
+
+    def get_readings(self, time_slot):
+        timestamp = TimeSlot(time_slot).time_to_ms(time_slot)
+        rate = self.profile.get_rate(time_slot)
+
+        # Poisson arrivals per truck, spread across the minute
+        counts = self.fleet.rng.poisson(rate, len(self.fleet))
+        trucks = [np.repeat(np.arange(len(self.fleet)), counts)]
+        timestamps = [timestamp + self.fleet.rng.integers(0, 60000, len(trucks[0]))]
+
+        for city_name, minutes in self.profile.get_backlogs(time_slot):
+            city_trucks = self.fleet.get_city_trucks(city_name)
+            replay_minutes = np.repeat(np.arange(1, minutes + 1), len(city_trucks))
+            trucks.append(np.tile(city_trucks, minutes))
+            timestamps.append(timestamp - replay_minutes * 60000)
+
+        trucks = np.concatenate(trucks)
+        lat, lon, load = self.fleet.simulate(1, self.weighting, trucks)
+        return self.fleet.payloads(np.concatenate(timestamps), lat[0], lon[0], load[0], trucks)
+
+    def run(self):
+        print(f"LOADTEST: {len(self.fleet)} trucks in {len(self.fleet.cities)} cities, ids use {self.fleet.ids.nbytes} bytes")
+        start = perf_counter()
+        peak = 0
+        time_slot = TimeSlot(self.begin_time)
+        while self.end_time - timedelta(minutes=1) > time_slot.time_slot:
+            time_slot.increment_time_slot()
+            payloads = self.get_readings(time_slot.time_slot)
+            size = self.sink.write(time_slot.time_slot, payloads)
+            peak = max(peak, len(payloads))
+            print(f"LOADTEST: {time_slot.time_slot.isoformat()} {len(payloads)} readings, {size} bytes")
+
+        elapsed = perf_counter() - start
+        print(f"LOADTEST: {self.sink.readings} readings in {self.sink.files} files, {self.sink.bytes} bytes, "
+            f"peak {peak} readings per slot, {self.sink.readings / elapsed:.0f} readings/s generated")
+
+
+@dataclass
+class Daemon:
+    fleet : Fleet
+    emit : object
+    cadence_min : float = 1.0
+    cadence_max : float = 10.0
+    jitter : float = 0.5
+    weighting : float = 1.0
+    report_seconds : float = 10.0
+
+    def __post_init__(self):
+        # Every truck reports on its own cadence, jittered per reading
+        self.cadence = self.fleet.rng.uniform(self.cadence_min, self.cadence_max, len(self.fleet))
+        self.running = True
+
+    def stop(self, *args):
+        self.running = False
+
+    def report(self, elapsed, emitted, lags):
+        lags = np.array(lags) * 1000 if lags else np.zeros(1)
+        p50, p99 = np.percentile(lags, [50, 99])
+        print(f"DAEMON: {emitted / elapsed:.0f} readings/s, scheduling lag p50 {p50:.1f}ms p99 {p99:.1f}ms max {lags.max():.1f}ms")
+
+    def run(self, duration=None):
+        start = perf_counter()
+        wall_start = datetime.now().timestamp()
+        # First readings are spread over one cadence so the fleet does not report in lockstep
+        first_due = start + self.fleet.rng.uniform(0, self.cadence)
+        schedule = list(zip(first_due.tolist(), range(len(self.fleet))))
+        heapq.heapify(schedule)
+        print(f"DAEMON: Scheduling {len(self.fleet)} trucks every {self.cadence_min}-{self.cadence_max}s")
+
+        report_start = start
+        emitted = 0
+        lags = []
+        while self.running and (duration is None or perf_counter() - start < duration):
+            now = perf_counter()
+            if now >= report_start + self.report_seconds:
+                self.report(now - report_start, emitted, lags)
+                report_start = now
+                emitted = 0
+                lags = []
+
+            if schedule[0][0] > now:
+                sleep(min(schedule[0][0], report_start + self.report_seconds) - now)
+                continue
+
+            due = []
+            trucks = []
+            while schedule and schedule[0][0] <= now:
+                truck_due, truck = heapq.heappop(schedule)
+                due.append(truck_due)
+                trucks.append(truck)
+            due = np.array(due)
+            trucks = np.array(trucks)
+
+            # Readings carry their scheduled time, lag is how late the scheduler picked them up
+            lat, lon, load = self.fleet.simulate(1, self.weighting, trucks)
+            timestamps = ((wall_start + due - start) * 1000).astype(np.int64)
+            self.emit(self.fleet.payloads(timestamps, lat[0], lon[0], load[0], trucks))
+            lags.extend((now - due).tolist())
+            emitted += len(trucks)
+
+            jitter = self.fleet.rng.uniform(-self.jitter, self.jitter, len(trucks))
+            next_due = due + np.maximum(self.cadence[trucks] + jitter, 0.1)
+            for truck_due, truck in zip(next_due.tolist(), trucks.tolist()):
+                heapq.heappush(schedule, (truck_due, truck))
+
+
+@dataclass
+class DaemonFileSink:
+    sink : LocalSink
+    flush_seconds : float = 60.0
+
+    def __post_init__(self):
+        self.payloads = []
+        self.flushed_at = perf_counter()
+
+    def __call__(self, payloads):
+        # Buffered like Firehose, one file per flush interval
+        self.payloads.extend(payloads)
+        if perf_counter() - self.flushed_at >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.payloads:
+            self.sink.write(datetime.now(), self.payloads)
+        self.payloads = []
+        self.flushed_at = perf_counter()
+
+
+@dataclass
+class DaemonMqttSink:
+    publisher : MqttPublisher
+    flush_seconds : float = 10.0
+
+    def __post_init__(self):
+        self.flushed_at = perf_counter()
+
+    def __call__(self, payloads):
+        for topic, payload in get_messages(payloads):
+            self.publisher.publish(topic, payload)
+        if perf_counter() - self.flushed_at >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        self.publisher.flush()
+        self.flushed_at = perf_counter()
 
 
 @dataclass
@@ -161,104 +857,155 @@ class Application:
     historical_begin_time : str = "2018-12-31T00:00:00"
     historical_end_time : str = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
     weighting : float = 1.0
+    seed : int = 0
+    shard_days : int = SHARD_DAYS
 
     def __post_init__(self):
         self.collection_process()
-        self.init_certs()
 
 
     def collection_process(self):
-        CITY_LABELS = ["glasgow", "edinburgh", "dundee", "inverness", "aberdeen"]
+        global FLEET
+        if FLEET is not None:
+            print(f"INIT: Reused fleet, saved {INIT_SECONDS['fleet']:.3f}s")
+        else:
+            start = perf_counter()
+            CITY_LABELS = ["glasgow", "edinburgh", "dundee", "inverness", "aberdeen"]
 
-        self.cities = []
-        for city in CITY_LABELS:
-            locals()[city] = City(city)
-            self.cities.append(locals()[city])
+            cities = []
+            for city in CITY_LABELS:
+                locals()[city] = City(city)
+                cities.append(locals()[city])
 
-        self.trucks = []
-        for city in self.cities:
-            city_inventory = TruckInventory(city.name)
-            for truck in city_inventory.inventory:
-                self.trucks.append(BinTruck(truck["id"], city))
+            FLEET = Fleet(cities)
+            INIT_SECONDS['fleet'] = perf_counter() - start
 
+        self.fleet = FLEET
+        self.cities = FLEET.cities
 
-    def init_certs(self):
-        BUCKET_NAME = os.environ.get('KEYS_BUCKET', 'no-bucket')
-        OBJECTS_ = ["1e6a88bcb8-certificate.pem.crt",
-            "1e6a88bcb8-private.pem.key",
-            "AmazonRootCA1.pem"
-        ]
 
-        s3 = boto3.resource('s3')
-        for object_ in OBJECTS_:
-            try:
-                s3.Bucket(BUCKET_NAME).download_file(object_, "/tmp/" + object_)
-            except:
-                print("COPYFILE: Could not copy file from S3")
+    def process_live(self):
+        time_slot = TimeSlot(datetime.now())
+        if time_slot.work_day_start <= time_slot.time_slot.time() < time_slot.work_day_end:
+            publisher = get_mqtt_publisher()
+            start = perf_counter()
+            timestamp = time_slot.time_to_ms(time_slot.time_slot)
+            lat, lon, load = self.fleet.simulate(1, self.weighting)
+            payloads = self.fleet.payloads(timestamp, lat[0], lon[0], load[0])
+            messages = self.get_batched_messages(timestamp, payloads) if LIVE_BATCHING else get_messages(payloads)
+            if LIVE_PUBLISHER == "async":
+                stats = asyncio.run(get_async_publisher().publish_all(messages))
+                summary = stats.export()
+                published, failed = summary["Published"], summary["Dropped"]
+            else:
+                for topic, payload in messages:
+                    publisher.publish(topic, payload)
+                published, failed = publisher.flush()
+            print(f"PUBLISHSTATS: {published} published, {failed} failed in {perf_counter() - start:.3f}s")
 
 
-            if os.path.isfile("/tmp/" + object_):
-                print(f"CHECKFILE: {object_} exists")
-            else:
-                print(f"CHECKFILE: {object_} doesnt exist")
+    def get_batched_messages(self, timestamp, payloads):
+        # Trucks are held contiguously per city, so each city's readings are one slice of the payloads
+        messages = []
+        city_ends = np.cumsum(np.bincount(self.fleet.city_index, minlength=len(self.fleet.cities)))
+        for city, city_end, city_start in zip(self.fleet.cities, city_ends, np.concatenate([[0], city_ends[:-1]])):
+            for part, start in enumerate(range(city_start, city_end, BATCH_MAX_READINGS)):
+                readings = payloads[start:min(start + BATCH_MAX_READINGS, city_end)]
+                messages.append((f"waste/household/city/{city.name}/batch",
+                    {"city" : city.name, "timestamp" : timestamp, "part" : part, "readings" : readings}))
+        return messages
 
 
-    def process_live(self):
-        waste = Waste()
-        time_slot = TimeSlot(datetime.now())
-        if time_slot.work_day_start <= time_slot.time_slot.time() < time_slot.work_day_end:
-            for truck in self.trucks:
-                truck.move_down_road()
-                mqtt_message = MqttMessage()
-                mqtt_message.send(truck, time_slot, waste, self.weighting)
-                del mqtt_message
+    def get_shards(self):
+        begin_time = datetime.strptime(self.historical_begin_time, "%Y-%m-%dT%H:%M:%S")
+        end_time = datetime.strptime(self.historical_end_time, "%Y-%m-%dT%H:%M:%S")
+        # The last slot can roll over to the morning after end_time
+        final_day = end_time.date() + timedelta(days=1)
+        shards = []
+        first_day = begin_time.date()
+        while first_day <= final_day:
+            last_day = min(first_day + timedelta(days=self.shard_days), final_day + timedelta(days=1))
+            shards.append(Shard(len(shards), first_day, last_day))
+            first_day = last_day
+        return shards
+
+
+    def get_run_id(self):
+        run = f"{self.historical_begin_time}|{self.historical_end_time}|{self.weighting}|{self.seed}|{self.shard_days}"
+        return hashlib.sha1(run.encode("utf-8")).hexdigest()[:12]
 
 
-    def process_historical(self):
-        ts = datetime.strptime(self.historical_begin_time, "%Y-%m-%dT%H:%M:%S")
-        historical_slot =  TimeSlot(ts)
+    def process_historical(self, worker=0, workers=1, context=None):
+        begin_time = datetime.strptime(self.historical_begin_time, "%Y-%m-%dT%H:%M:%S")
         end_time = datetime.strptime(self.historical_end_time, "%Y-%m-%dT%H:%M:%S")
-        waste = Waste()
-
-        def send_sqs(time_slot, payloads):
-            print("PUBLISHSQS: Pubish message to SQS")
-            sqs = boto3.client('sqs')
-            queue_url = os.environ['SQS_URL']
-            message_id = None
-            while message_id is None:
-                result = sqs.send_message(
-                    QueueUrl=queue_url,
-                    DelaySeconds=10,
-                    MessageAttributes={
-                        'timeslot': {
-                            'DataType': 'String',
-                            'StringValue': time_slot.isoformat()
-                        }
-                    },
-                    MessageBody=(payloads)
-                )
-                message_id = result['MessageId']
-                print(f"SENTSQS: Messsage received as MessageID: {message_id}")
-
-
-        def do_work(timestamp):
-            payloads : str = ""
-            for truck in self.trucks:
-                truck.move_down_road()
-                payload = {}
-                payload.update({"timestamp" : timestamp})
-                payload.update({"truck_id" : truck.id})
-                payload.update({"lat" : truck.position[0]})
-                payload.update({"lon" : truck.position[1]})
-                payload.update({"load" : waste.get_waste() * self.weighting})
-                payloads = payloads + (json.dumps(payload)) + ","
-            send_sqs(historical_slot.time_slot, payloads)
-
-
-        while end_time - timedelta(minutes=1) > historical_slot.time_slot :
-            historical_slot.increment_time_slot()
-            timestamp = historical_slot.time_to_ms(historical_slot.time_slot)
-            do_work(timestamp)
+        checkpoint = Checkpoint(self.get_run_id())
+        completed = checkpoint.completed_shards()
+        shards = [shard for shard in self.get_shards()[worker::workers] if shard.index not in completed]
+        print(f"PROCESS: Worker {worker}/{workers} has {len(shards)} shards to process")
+
+        print("PUBLISHSQS: Publishing messages to SQS")
+        sqs_sender = SqsBatchSender(os.environ['SQS_URL'])
+        message = BatchMessage(sqs_sender)
+        truck_ids = self.fleet.ids.astype(str)
+
+        def do_work(time_slots):
+            lat, lon, load = self.fleet.simulate(len(time_slots), self.weighting)
+            for slot, time_slot in enumerate(time_slots):
+                timestamp = TimeSlot(time_slot).time_to_ms(time_slot)
+                message.add(time_slot, wire_format.encode_frame(timestamp, truck_ids, lat[slot], lon[slot], load[slot]))
+
+
+        finished = True
+        for position, shard in enumerate(shards):
+            if context is not None and context.get_remaining_time_in_millis() < TIMEOUT_MARGIN_MS:
+                print(f"PROCESS: Stopping before timeout, {len(shards) - position} shards left")
+                finished = False
+                break
+
+            start = perf_counter()
+            self.fleet.rng = shard.get_rng(self.seed)
+            time_slots = []
+            slot_count = 0
+            for time_slot in shard.time_slots(begin_time, end_time):
+                time_slots.append(time_slot)
+                if len(time_slots) == SLOT_BLOCK_SIZE:
+                    do_work(time_slots)
+                    slot_count += len(time_slots)
+                    time_slots = []
+            if time_slots:
+                do_work(time_slots)
+                slot_count += len(time_slots)
+
+            message.flush()
+            sent, failed = sqs_sender.flush()
+            if failed:
+                raise RuntimeError(f"{failed} messages in shard {shard.index} were not sent to SQS")
+            checkpoint.save(shard, {"first_day" : shard.first_day.isoformat(), "last_day" : shard.last_day.isoformat(),
+                "time_slots" : slot_count, "seconds" : round(perf_counter() - start, 3)})
+            print(f"PUBLISHSTATS: Shard {shard.index} sent {slot_count} time slots in {perf_counter() - start:.3f}s")
+
+        sqs_sender.executor.shutdown()
+        self.fleet.rng = np.random.default_rng()
+        return finished
+
+
+def get_application(event):
+    return Application(event.get("timeslot", Application.historical_begin_time),
+        event.get("endtime", Application.historical_end_time),
+        event.get("weighting", 1.0),
+        event.get("seed", 0),
+        event.get("shard-days", SHARD_DAYS))
+
+
+def invoke_self(event):
+    get_client('lambda').invoke(FunctionName=os.environ['AWS_LAMBDA_FUNCTION_NAME'],
+        InvocationType='Event',
+        Payload=json.dumps(event))
+
+
+def run_historical_worker(event, worker, workers):
+    app = get_application(event)
+    return app.process_historical(worker, workers)
 
 
 # Lambda handler
@@ -272,20 +1019,126 @@ def handler(event, context):
     if "historical-process" in event:
         if event["historical-process"] == True:
             print("PROCESS: Processing historical data")
-            if "timeslot" in event:
-                app = Application(event["timeslot"], event["endtime"])
-                app.process_historical()
-            else:
-                app.process_historical()
+            # The window is fixed before any re-invocation so continuations and workers share a run id
+            event = {**event, "timeslot" : event.get("timeslot", Application.historical_begin_time),
+                "endtime" : event.get("endtime", datetime.now().strftime("%Y-%m-%dT%H:%M:%S"))}
+            workers = event.get("workers", 1)
+            if workers > 1 and "worker" not in event:
+                print(f"PROCESS: Fanning out to {workers} workers")
+                for worker in range(workers):
+                    invoke_self({**event, "worker" : worker})
+                return
+
+            app = get_application(event)
+            if not app.process_historical(event.get("worker", 0), workers, context):
+                if CHECKPOINT_BUCKET is None:
+                    print("PROCESS: Not continuing, without CHECKPOINT_BUCKET a new invocation would start again")
+                    return
+                print("PROCESS: Continuing in a new invocation")
+                invoke_self(event)
+
+
+def parse_fleet(fleet, synthetic_cities, synthetic_trucks):
+    quantities = dict(TRUCK_QUANTITY)
+    if fleet:
+        quantities = {}
+        for city in fleet.split(","):
+            name, volume = city.split("=")
+            quantities[name] = int(volume)
+
+    cities = [City(name) for name in quantities]
+    for index in range(synthetic_cities):
+        city = get_synthetic_city(index)
+        cities.append(city)
+        quantities[city.name] = synthetic_trucks
+    return cities, quantities
+
+
+def run_load_test(args):
+    cities, quantities = parse_fleet(args.fleet, args.synthetic_cities, args.synthetic_trucks)
+    fleet = Fleet(cities, np.random.default_rng(args.seed), quantities)
+    profile = TrafficProfile(args.rate, args.rush_hour, args.backlog)
+    load_test = LoadTest(fleet, profile, LocalSink(args.output),
+        datetime.strptime(args.begin, "%Y-%m-%dT%H:%M:%S"),
+        datetime.strptime(args.end, "%Y-%m-%dT%H:%M:%S"),
+        args.weighting)
+    load_test.run()
+
+
+def run_daemon(args):
+    cities, quantities = parse_fleet(args.fleet, args.synthetic_cities, args.synthetic_trucks)
+    fleet = Fleet(cities, np.random.default_rng(args.seed), quantities)
+    if args.output is None:
+        sink = DaemonMqttSink(get_mqtt_publisher())
+    else:
+        sink = DaemonFileSink(LocalSink(args.output), args.flush_seconds)
+
+    daemon = Daemon(fleet, sink, args.cadence_min, args.cadence_max, args.jitter, args.weighting)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run(args.duration)
+    sink.flush()
+
+
+def run_historical(args):
+    event = { "historical-process" : True,
+                "timeslot" : args.begin,
+                "endtime" : args.end,
+                "weighting" : args.weighting,
+                "seed" : args.seed,
+                "shard-days" : args.shard_days}
+
+    # Each local process takes every n-th shard, the same split used by fanned out invocations
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(run_historical_worker, event, worker, args.workers) for worker in range(args.workers)]
+        for future in futures:
+            future.result()
 
 
 # Non Lambda Execution
 def main():
-    event = { "historical-process" : True, 
-                "timeslot" : "2020-12-31T20:00:00",
-                "endtime" :  "2021-10-19T17:31:00",
-                "weighting" : 0.9}
-    handler(event, "")
+    parser = argparse.ArgumentParser(description="Waste collection data generator")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    historical = subparsers.add_parser("historical", help="backfill historical data to SQS")
+    historical.add_argument("--begin", default="2020-12-31T20:00:00", help="historical start time")
+    historical.add_argument("--end", default="2021-10-19T17:31:00", help="historical end time")
+    historical.add_argument("--weighting", type=float, default=0.9)
+    historical.add_argument("--seed", type=int, default=0)
+    historical.add_argument("--shard-days", type=int, default=SHARD_DAYS)
+    historical.add_argument("--workers", type=int, default=1, help="local worker processes")
+    historical.set_defaults(func=run_historical)
+
+    load_test = subparsers.add_parser("load-test", help="generate a configurable load to a local sink")
+    load_test.add_argument("--begin", default="2021-01-03T16:30:00", help="simulated start time")
+    load_test.add_argument("--end", default="2021-01-04T16:31:00", help="simulated end time")
+    load_test.add_argument("--fleet", help="trucks per city, e.g. glasgow=40000,edinburgh=30000")
+    load_test.add_argument("--synthetic-cities", type=int, default=0, help="extra generated cities")
+    load_test.add_argument("--synthetic-trucks", type=int, default=1000, help="trucks per synthetic city")
+    load_test.add_argument("--rate", type=float, default=1.0, help="readings per truck per minute")
+    load_test.add_argument("--rush-hour", action="append", default=[], help="rate multiplier window, e.g. 07:00-09:00x3")
+    load_test.add_argument("--backlog", action="append", default=[], help="city backlog replay, e.g. dundee:60@12:00")
+    load_test.add_argument("--weighting", type=float, default=1.0)
+    load_test.add_argument("--seed", type=int, default=0)
+    load_test.add_argument("--output", default="/tmp/loadtest", help="local sink directory")
+    load_test.set_defaults(func=run_load_test)
+
+    daemon = subparsers.add_parser("daemon", help="long running per second telemetry, to MQTT or a local sink")
+    daemon.add_argument("--fleet", help="trucks per city, e.g. glasgow=40000,edinburgh=30000")
+    daemon.add_argument("--synthetic-cities", type=int, default=0, help="extra generated cities")
+    daemon.add_argument("--synthetic-trucks", type=int, default=1000, help="trucks per synthetic city")
+    daemon.add_argument("--cadence-min", type=float, default=1.0, help="shortest seconds between a truck's readings")
+    daemon.add_argument("--cadence-max", type=float, default=10.0, help="longest seconds between a truck's readings")
+    daemon.add_argument("--jitter", type=float, default=0.5, help="seconds of jitter per reading")
+    daemon.add_argument("--duration", type=float, help="seconds to run for, runs until stopped by default")
+    daemon.add_argument("--weighting", type=float, default=1.0)
+    daemon.add_argument("--seed", type=int)
+    daemon.add_argument("--output", help="local sink directory, publishes to MQTT when not set")
+    daemon.add_argument("--flush-seconds", type=float, default=60.0, help="local sink file interval")
+    daemon.set_defaults(func=run_daemon)
+
+    args = parser.parse_args()
+    args.func(args)
 
 
 if __name__ == "__main__":
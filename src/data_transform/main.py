@@ -1,18 +1,89 @@
+from collections import OrderedDict
 from dataclasses import dataclass, field
 import boto3
+import codecs
 import json as json
 import os
+import re
 import redis
 import secrets
-from operator import itemgetter
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
+import numpy as np
 import pandas as pd
+from scipy.spatial import cKDTree
+
+import processed_schema
+import wire_format
+
+# Raw objects are streamed and enriched this many readings at a time
+READ_CHUNK_BYTES = 1024 * 1024
+BATCH_RECORDS = 50000
+MAX_RECORD_BYTES = 64 * 1024
+SEPARATORS = re.compile(r"[\s,\[\]]*")
+READING_FIELDS = {"timestamp", "truck_id", "lat", "lon", "load"}
+
+# Readings without a known postcode or outcode are recorded against this placeholder
+FALLBACK_POSTCODE = "XX99 9ZZ"
+FALLBACK_OUTCODE = "XX99"
+FALLBACK_LAT = 56.816918399
+FALLBACK_LON = -4.1826492694
+
+# Nearest postcode lookups, "local" uses an in process index of the reference CSVs, "redis" uses Elasticache
+GEO_BACKEND = os.environ.get('GEO_BACKEND', 'local')
+REFERENCE_BUCKET = os.environ.get('REFERENCE_BUCKET')
+REFERENCE_PREFIX = "reference/"
+REFDATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "refdata")
+EARTH_RADIUS_MILES = 3958.8
+MAX_SEARCH_MILES = 1000
+# Commands sent per Redis round trip
+REDIS_PIPELINE_SIZE = 5000
+
+# Nearest postcodes memoised per grid cell of GEO_CELL_DEGREES, optionally shared between containers through Redis
+GEO_CELL_DEGREES = float(os.environ.get('GEO_CELL_DEGREES', 0.0005))
+GEO_CACHE_SIZE = int(os.environ.get('GEO_CACHE_SIZE', 500000))
+GEO_CACHE_SHARED = os.environ.get('GEO_CACHE_SHARED', 'false').lower() == 'true'
+GEO_CACHE_TTL = 86400
+
+# Files from one S3 notification are transformed concurrently, downloads and uploads overlapping enrichment
+TRANSFORM_WORKERS = int(os.environ.get('TRANSFORM_WORKERS', 4))
+
+# Built once per container and reused while it is warm
+CODE_DB = None
+CODE_DB_LOCK = threading.Lock()
+
+s3 = boto3.client('s3')
+
+
+class FileStats(threading.local):
+    # Files are transformed one per thread, so counts kept per thread are the current file's alone
+    def __init__(self, *names):
+        self.counts = dict.fromkeys(names, 0)
+
+    def __getitem__(self, name):
+        return self.counts[name]
+
+    def __setitem__(self, name, value):
+        self.counts[name] = value
+
+    def reset(self):
+        self.counts = dict.fromkeys(self.counts, 0)
 
 
 @dataclass
 class CodeDB:
+    bucket : str = None
 
     def __post_init__(self):
+        self.stats = FileStats("searches", "round_trips", "cap_hits", "misses")
         self.connect_redis()
+        # Outcodes are a small static set, held in memory so only postcodes need Redis
+        try:
+            self.outcodes = SpatialIndex(*load_reference("outcodes.csv", self.bucket))
+        except Exception as ex:
+            print(f"GEOINDEX: Outcode table unavailable, {ex}, using Redis")
+            self.outcodes = None
 
     def connect_redis(self):
         endpoint : str = os.environ.get('REDIS_ENDPOINT')
@@ -23,7 +94,7 @@ class CodeDB:
                 host=endpoint,
                 port=port,
                 db=2,
-                charset="utf-8",
+                encoding="utf-8",
                 decode_responses=True)
             self.conn.ping()
             print('Connected to Elasticache')
@@ -32,30 +103,412 @@ class CodeDB:
             print(f"Error: {ex}")
             exit("Failed to connect, terminating")
 
-    def find_closest_postcode(self, lon, lat):
-        postcodes = []
+    def search(self, key, lons, lats, count=1):
+        # One GEOSEARCH per distinct location and round, only locations short of matches move on to a wider radius
+        locations = list(dict.fromkeys(zip(lons, lats)))
+        found = {}
         miles = 1
-        while postcodes == [] or miles == 1000:
-            postcodes = self.conn.georadius("postcodes", lon, lat, miles, unit="mi", withdist=True)
-            miles +=1 
-        sorted_postcodes = sorted(postcodes, key=itemgetter(1))
-        return sorted_postcodes[0][0]
-
-    
-    def find_closest_outcode(self, lon, lat):
-        outcodes = []
-        miles = 1
-        while outcodes == [] or miles == 1000:
-            outcodes = self.conn.georadius("outcodes", lon, lat, miles, unit="mi", withdist=True)
-            miles +=1 
-        sorted_outcodes= sorted(outcodes, key=itemgetter(1))
-        return sorted_outcodes[0][0]
+        while locations:
+            results = self.run_pipeline([("geosearch", key, {"longitude" : lon, "latitude" : lat, "radius" : miles,
+                "unit" : "mi", "sort" : "ASC", "count" : count, "withdist" : True}) for lon, lat in locations])
+            self.stats["searches"] += len(locations)
+            pending = []
+            for location, result in zip(locations, results):
+                found[location] = result
+                if len(result) < count:
+                    pending.append(location)
+            locations = pending
+            if miles >= MAX_SEARCH_MILES:
+                self.stats["cap_hits"] += len(locations)
+                break
+            miles = min(miles * 2, MAX_SEARCH_MILES)
+        return [found[location] for location in zip(lons, lats)]
+
+    def find_closest(self, key, lons, lats):
+        return [result[0][0] if result else "" for result in self.search(key, lons, lats)]
+
+    def nearest_two_postcodes(self, lons, lats):
+        results = self.search("postcodes", lons, lats, count=2)
+        codes = [result[0][0] if result else "" for result in results]
+        first = np.array([result[0][1] if result else np.inf for result in results], dtype=float)
+        second = np.array([result[1][1] if len(result) > 1 else np.inf for result in results], dtype=float)
+        return codes, first, second
+
+    def lookup(self, key, codes):
+        members = list(dict.fromkeys(code for code in codes if code))
+        positions = {}
+        for i in range(0, len(members), REDIS_PIPELINE_SIZE):
+            chunk = members[i:i + REDIS_PIPELINE_SIZE]
+            self.stats["round_trips"] += 1
+            positions.update(zip(chunk, self.conn.geopos(key, *chunk)))
+        found = [positions.get(code) for code in codes]
+        lon = np.array([position[0] if position else np.nan for position in found], dtype=float)
+        lat = np.array([position[1] if position else np.nan for position in found], dtype=float)
+        self.stats["misses"] += int(np.isnan(lon).sum())
+        return lon, lat, ~np.isnan(lon)
+
+    def run_pipeline(self, commands):
+        results = []
+        for i in range(0, len(commands), REDIS_PIPELINE_SIZE):
+            pipe = self.conn.pipeline(transaction=False)
+            for command, key, kwargs in commands[i:i + REDIS_PIPELINE_SIZE]:
+                getattr(pipe, command)(key, **kwargs)
+            self.stats["round_trips"] += 1
+            results.extend(pipe.execute())
+        return results
+
+    def find_closest_postcodes(self, lons, lats):
+        return self.find_closest("postcodes", lons, lats)
+
+    def find_closest_outcodes(self, lons, lats):
+        return self.find_closest("outcodes", lons, lats)
+
+    def lookup_postcodes(self, postcodes):
+        return self.lookup("postcodes", postcodes)
+
+    def lookup_outcodes(self, outcodes):
+        if self.outcodes is not None:
+            return self.outcodes.lookup(outcodes)
+        return self.lookup("outcodes", outcodes)
+
+    def report(self):
+        print(f"GEOSEARCH: {self.stats['searches']} searches in {self.stats['round_trips']} round trips, "
+            f"{self.stats['cap_hits']} reached {MAX_SEARCH_MILES} miles, {self.stats['misses']} codes without a position")
+        self.stats.reset()
+
+
+def to_unit_vectors(lat, lon):
+    # Chord distance between unit vectors orders points the same as haversine distance
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def chord_to_miles(chord):
+    return 2 * np.arcsin(np.minimum(chord / 2, 1)) * EARTH_RADIUS_MILES
+
+
+def load_reference(csv, bucket):
+    path = os.path.join(REFDATA_DIR, csv)
+    if not os.path.isfile(path):
+        path = "/tmp/" + csv
+        if not os.path.isfile(path):
+            print(f"GEOINDEX: Downloading s3://{bucket}/{REFERENCE_PREFIX}{csv}")
+            s3.download_file(bucket, REFERENCE_PREFIX + csv, path)
+
+    df = pd.read_csv(path, usecols=["postcode", "latitude", "longitude"]).dropna()
+    # Postcodes without a location are recorded at 99.999999, 0
+    df = df[df["latitude"].between(49, 61) & df["longitude"].between(-9, 2)].drop_duplicates("postcode")
+    print(f"GEOINDEX: Loaded {len(df)} codes from {csv}")
+    return df["postcode"].to_numpy(dtype=str), df["latitude"].to_numpy(), df["longitude"].to_numpy()
+
+
+@dataclass
+class SpatialIndex:
+    codes : np.ndarray
+    lat : np.ndarray
+    lon : np.ndarray
+
+    def __post_init__(self):
+        self.tree = cKDTree(to_unit_vectors(self.lat, self.lon))
+        self.index = pd.Index(self.codes)
+
+    def nearest(self, lons, lats, k=1):
+        chord, index = self.tree.query(to_unit_vectors(lats, lons), k=k)
+        return index, chord_to_miles(chord)
+
+    def find_closest(self, lons, lats):
+        index, miles = self.nearest(lons, lats)
+        return np.where(miles <= MAX_SEARCH_MILES, self.codes[index], "")
+
+    def nearest_two(self, lons, lats):
+        index, miles = self.nearest(lons, lats, k=2)
+        return np.where(miles[:, 0] <= MAX_SEARCH_MILES, self.codes[index[:, 0]], ""), miles[:, 0], miles[:, 1]
+
+    def lookup(self, codes):
+        ids = self.index.get_indexer(np.asarray(codes, dtype=object))
+        found = ids >= 0
+        return np.where(found, self.lon[ids], np.nan), np.where(found, self.lat[ids], np.nan), found
+
+
+@dataclass
+class LocalCodeDB:
+    bucket : str = None
+
+    def __post_init__(self):
+        self.postcodes = SpatialIndex(*load_reference("postcodes.csv", self.bucket))
+        self.outcodes = SpatialIndex(*load_reference("outcodes.csv", self.bucket))
+        self.stats = FileStats("searches")
+
+    def find_closest_postcodes(self, lons, lats):
+        self.stats["searches"] += len(lons)
+        return self.postcodes.find_closest(lons, lats)
+
+    def find_closest_outcodes(self, lons, lats):
+        return self.outcodes.find_closest(lons, lats)
+
+    def nearest_two_postcodes(self, lons, lats):
+        self.stats["searches"] += len(lons)
+        return self.postcodes.nearest_two(lons, lats)
+
+    def lookup_postcodes(self, postcodes):
+        return self.postcodes.lookup(postcodes)
 
-    def lookup_postcode(self, postcode):
-        return self.conn.geopos("postcodes", postcode)
+    def lookup_outcodes(self, outcodes):
+        return self.outcodes.lookup(outcodes)
 
-    def lookup_outcode(self, outcode):
-        return self.conn.geopos("outcodes", outcode)
+    def report(self):
+        print(f"GEOINDEX: {self.stats['searches']} searches")
+        self.stats.reset()
+
+
+def haversine_miles(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(value) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(a)) * EARTH_RADIUS_MILES
+
+
+@dataclass
+class PostcodeCellCache:
+    code_db : object
+    cell_degrees : float = GEO_CELL_DEGREES
+    max_size : int = GEO_CACHE_SIZE
+    shared : bool = GEO_CACHE_SHARED
+
+    def __post_init__(self):
+        # Cell key to postcode, None marks a cell that straddles a boundary between postcodes
+        self.cells = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = FileStats("hits", "misses", "new_cells", "mixed_cells", "shared_hits")
+        self.conn = None
+        if self.shared:
+            self.connect_redis()
+
+    def connect_redis(self):
+        try:
+            self.conn = redis.Redis(
+                host=os.environ.get('REDIS_ENDPOINT'),
+                port=os.environ.get('REDIS_PORT'),
+                db=3,
+                encoding="utf-8",
+                decode_responses=True)
+            self.conn.ping()
+        except Exception as ex:
+            print(f"GEOCACHE: Shared cache unavailable, {ex}")
+            self.conn = None
+
+    def cell_keys(self, lons, lats):
+        # Row and column packed into one integer, columns offset so they stay positive
+        rows = np.floor(lats / self.cell_degrees).astype(np.int64)
+        cols = np.floor(lons / self.cell_degrees).astype(np.int64)
+        return (rows << 32) + cols + (1 << 31)
+
+    def resolve_cells(self, keys):
+        # Every point of a cell is within its circumradius of the centre, so the centre's nearest postcode is the
+        # nearest for the whole cell when the runner up is more than twice that radius further away
+        keys = np.asarray(keys, dtype=np.int64)
+        rows, cols = keys >> 32, (keys & 0xffffffff) - (1 << 31)
+        south, west = rows * self.cell_degrees, cols * self.cell_degrees
+        centre_lat, centre_lon = south + self.cell_degrees / 2, west + self.cell_degrees / 2
+        radius = np.maximum(haversine_miles(centre_lat, centre_lon, south, west),
+            haversine_miles(centre_lat, centre_lon, south + self.cell_degrees, west))
+        codes, first, second = self.code_db.nearest_two_postcodes(centre_lon, centre_lat)
+        uniform = (second - first) > 2 * radius
+        # Keys go back to Python ints, redis cannot encode numpy integers
+        return {key : (str(code) if is_uniform else None) for key, code, is_uniform in zip(keys.tolist(), codes, uniform)}
+
+    def get_shared(self, keys):
+        if self.conn is None or not keys:
+            return {}
+        try:
+            values = self.conn.hmget(f"postcode_cells:{self.cell_degrees}", keys)
+        except Exception as ex:
+            print(f"GEOCACHE: Shared cache read failed, {ex}")
+            return {}
+        found = {key : value for key, value in zip(keys, values) if value}
+        self.stats["shared_hits"] += len(found)
+        return found
+
+    def put_shared(self, cells):
+        if self.conn is None or not cells:
+            return
+        try:
+            pipe = self.conn.pipeline(transaction=False)
+            pipe.hset(f"postcode_cells:{self.cell_degrees}", mapping=cells)
+            pipe.expire(f"postcode_cells:{self.cell_degrees}", GEO_CACHE_TTL)
+            pipe.execute()
+        except Exception as ex:
+            print(f"GEOCACHE: Shared cache write failed, {ex}")
+
+    def find_closest_postcodes(self, lons, lats):
+        lons, lats = np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)
+        inverse, keys = pd.factorize(self.cell_keys(lons, lats))
+        keys = keys.tolist()
+        values = {}
+        unknown = []
+        with self.lock:
+            for key in keys:
+                if key in self.cells:
+                    self.cells.move_to_end(key)
+                    values[key] = self.cells[key]
+                else:
+                    unknown.append(key)
+
+        shared = self.get_shared(unknown)
+        unknown = [key for key in unknown if key not in shared]
+        resolved = self.resolve_cells(unknown) if unknown else {}
+        self.put_shared({key : code for key, code in resolved.items() if code})
+        self.stats["new_cells"] += len(resolved)
+        self.stats["mixed_cells"] += sum(1 for code in resolved.values() if code is None)
+
+        values.update(shared)
+        values.update(resolved)
+        with self.lock:
+            self.cells.update(shared)
+            self.cells.update(resolved)
+            while len(self.cells) > self.max_size:
+                self.cells.popitem(last=False)
+
+        cell_postcodes = np.array([values[key] for key in keys], dtype=object)
+        postcodes = cell_postcodes[inverse]
+        misses = np.flatnonzero(np.array([code is None for code in cell_postcodes.tolist()], dtype=bool)[inverse])
+        if len(misses):
+            postcodes[misses] = self.code_db.find_closest_postcodes(lons[misses], lats[misses])
+        self.stats["hits"] += len(postcodes) - len(misses)
+        self.stats["misses"] += len(misses)
+        return postcodes
+
+    def find_closest_outcodes(self, lons, lats):
+        return self.code_db.find_closest_outcodes(lons, lats)
+
+    def lookup_postcodes(self, postcodes):
+        return self.code_db.lookup_postcodes(postcodes)
+
+    def lookup_outcodes(self, outcodes):
+        return self.code_db.lookup_outcodes(outcodes)
+
+    def report(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        hit_rate = 100 * self.stats["hits"] / lookups if lookups else 0
+        print(f"GEOCACHE: {hit_rate:.1f}% hit rate, {self.stats['hits']} hits, {self.stats['misses']} misses, "
+            f"{self.stats['new_cells']} new cells ({self.stats['mixed_cells']} mixed, {self.stats['shared_hits']} shared), "
+            f"{len(self.cells)} cached at {self.cell_degrees} degrees")
+        self.stats.reset()
+        self.code_db.report()
+
+
+def get_code_db(bucket):
+    global CODE_DB
+    with CODE_DB_LOCK:
+        if CODE_DB is None:
+            CODE_DB = create_code_db(bucket)
+    return CODE_DB
+
+
+def create_code_db(bucket):
+    if GEO_BACKEND == "local":
+        try:
+            code_db = LocalCodeDB(REFERENCE_BUCKET or bucket)
+        except Exception as ex:
+            print(f"GEOINDEX: Local index unavailable, {ex}, falling back to Redis")
+            code_db = CodeDB(REFERENCE_BUCKET or bucket)
+    else:
+        code_db = CodeDB(REFERENCE_BUCKET or bucket)
+    if GEO_CACHE_SIZE > 0:
+        code_db = PostcodeCellCache(code_db)
+    return code_db
+
+@dataclass
+class PeekableStream:
+    stream : object
+    head : bytes = b""
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data, self.head = self.head + self.stream.read(), b""
+            return data
+        data, self.head = self.head[:size], self.head[size:]
+        while len(data) < size:
+            chunk = self.stream.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+
+def iter_json_records(stream):
+    # Firehose objects are JSON readings separated by commas or newlines, parsed a chunk at a time so memory is
+    # bounded by the chunk size. Data that cannot be parsed is skipped up to the next object and counted.
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    buffer = ""
+    malformed = 0
+    skipped = 0
+    final = False
+    while not final:
+        chunk = stream.read(READ_CHUNK_BYTES)
+        final = not chunk
+        buffer += text_decoder.decode(chunk, final=final)
+        position = 0
+        while True:
+            position = SEPARATORS.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # A reading cut at the chunk boundary is completed by the next chunk, anything longer is malformed
+                if not final and len(buffer) - position <= MAX_RECORD_BYTES:
+                    break
+                end = buffer.find("{", position + 1)
+                end = len(buffer) if end < 0 else end
+                record = None
+            if isinstance(record, dict) and READING_FIELDS.issubset(record):
+                yield record
+            else:
+                malformed += 1
+                skipped += end - position
+            position = end
+        buffer = buffer[position:]
+    if malformed:
+        print(f"MALFORMED: Skipped {malformed} malformed readings, {skipped} characters")
+
+
+def records_to_columns(records):
+    count = len(records)
+    return {
+        "timestamp" : np.fromiter((i["timestamp"] for i in records), dtype=np.int64, count=count),
+        "truck_id" : np.array([i["truck_id"] for i in records], dtype=object),
+        "lat" : np.fromiter((i["lat"] for i in records), dtype=float, count=count),
+        "lon" : np.fromiter((i["lon"] for i in records), dtype=float, count=count),
+        "load" : np.fromiter((i["load"] for i in records), dtype=float, count=count),
+    }
+
+
+def iter_json_batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield records_to_columns(batch)
+            batch = []
+    if batch:
+        yield records_to_columns(batch)
+
+
+def iter_frame_batches(frames, size):
+    # Compact frames are already columnar, small ones are joined up to the batch size
+    pending = []
+    count = 0
+    for frame in frames:
+        pending.append(frame)
+        count += len(frame["timestamp"])
+        if count >= size:
+            yield {name : np.concatenate([frame[name] for frame in pending]) for name in pending[0]}
+            pending = []
+            count = 0
+    if pending:
+        yield {name : np.concatenate([frame[name] for frame in pending]) for name in pending[0]}
 
 
 @dataclass
@@ -67,95 +520,81 @@ class DataFile:
 
     def __post_init__(self):
         self.get_file_name()
-    
-    def get_file_name(self):
-        key_list = self.key.split("/")
-        self.file_name = key_list[-1]
-
-
-    def download_from_s3(self):
-        s3 = boto3.client('s3')
-        self.file_name = secrets.token_hex(6)
-        s3.download_file(self.bucket, self.key, self.temp_dir + self.file_name)
-        self.key = self.key.split("/")
-        # Removes suffix and prefix in original key
-        del self.key[-1]
-        del self.key[0]
-        self.key = "/".join(self.key)
-        print(f"WORKINGKEY: {self.key}/{self.file_name}")
 
+    def get_file_name(self):
+        # The output name follows the source so a retried file overwrites its earlier output
+        self.file_name = self.key.split("/")[-1]
+        self.writers = {}
+        print(f"WORKINGKEY: {self.key}")
+
+    def get_writer(self, partition):
+        if partition not in self.writers:
+            self.writers[partition] = processed_schema.RowGroupWriter(self.temp_dir + secrets.token_hex(6))
+        return self.writers[partition]
+
+    def read_batches(self):
+        body = s3.get_object(Bucket=self.bucket, Key=self.key)["Body"]
+        stream = PeekableStream(body)
+        stream.head = stream.read(len(wire_format.MAGIC))
+        # Historical files arrive in the compact batch format, live Firehose files as comma separated JSON
+        if wire_format.is_wire_format(stream.head):
+            print("COMPACTFORMAT: Decoding compact readings")
+            return iter_frame_batches(wire_format.iter_frames(stream), BATCH_RECORDS)
+        return iter_json_batches(iter_json_records(stream), BATCH_RECORDS)
+
+    def enrich(self, columns):
+        code_db = get_code_db(self.bucket)
+
+        # Nearest postcodes are resolved for the whole batch at once, then locations and outcodes per distinct postcode
+        postcodes = code_db.find_closest_postcodes(columns["lon"], columns["lat"])
+        inverse, postcodes = pd.factorize(np.asarray(postcodes, dtype=object))
+        postcodes = np.asarray(postcodes, dtype=object)
+        postcode_lon, postcode_lat, found = code_db.lookup_postcodes(postcodes)
+        print(f"FOUNDPOSTCODES: {len(inverse)} records, {len(postcodes)} postcodes")
+        postcodes[~found] = FALLBACK_POSTCODE
+        postcode_lat[~found] = FALLBACK_LAT
+        postcode_lon[~found] = FALLBACK_LON
+
+        outcodes = np.array([postcode.split(" ")[0] for postcode in postcodes.tolist()], dtype=object)
+        outcode_lon, outcode_lat, found = code_db.lookup_outcodes(outcodes)
+        outcodes[~found] = FALLBACK_OUTCODE
+        outcode_lat[~found] = FALLBACK_LAT
+        outcode_lon[~found] = FALLBACK_LON
+
+        enriched = {"postcode" : postcodes, "postcode_lat" : postcode_lat, "postcode_lon" : postcode_lon,
+            "outcode" : outcodes, "outcode_lat" : outcode_lat, "outcode_lon" : outcode_lon}
+        columns.update({name : values[inverse] for name, values in enriched.items()})
+        return processed_schema.to_batch(columns)
+
+    def transform(self):
+        # Stream the raw object and enrich it a batch at a time into a Parquet spill file per partition
+        try:
+            for columns in self.read_batches():
+                batch = self.enrich(columns)
+                for partition, rows in processed_schema.split_partitions(batch):
+                    self.get_writer(partition).write(batch.take(rows))
+        except Exception:
+            for writer in self.writers.values():
+                writer.close()
+                os.remove(writer.where)
+            raise
+        finally:
+            # Lookups are reported once per file, which also clears this thread's counts for the next file
+            if CODE_DB is not None:
+                CODE_DB.report()
+        for writer in self.writers.values():
+            writer.close()
+        return len(self.writers) > 0
 
     def upload_to_s3(self):
-        s3 = boto3.client('s3')
-        print(f"UPLOADTOS3: Uploading {self.file_name} to bucket: {self.bucket}, key: processed/{self.key}/{self.file_name}")
-        with open(self.temp_dir + self.file_name, "rb") as f:
-            s3.upload_fileobj(f, self.bucket, "processed/" + self.key + "/" + self.file_name)
-
-
-    def transform_to_parquet(self):
-        print(f"PARQUETCONVERT: Converting {self.temp_dir + self.file_name}")
-        data = pd.read_json(self.temp_dir + self.file_name)
-        data.to_parquet(self.temp_dir + self.file_name)
-
-
-
-    def transform_to_json(self):
-        with open(self.temp_dir + self.file_name, "r") as f:
-            data = f.read()
-            data = data[:-1]
-            data = f'[{data}]'
-            json_data = json.loads(data)
-        f.close()
-
-        with open(self.temp_dir + self.file_name, "w", encoding="utf-8") as f:
-            f.write(json.dumps(json_data, ensure_ascii=False))
-        f.close()
-
-
-    def postcode_enrich_json(self):
-        with open(self.temp_dir + self.file_name, "r") as f:
-            data = f.read()
-            json_data = json.loads(data)
-        f.close()
-        updated_json = []
-        code_db = CodeDB()
-        for i in json_data:
-            postcode = ""
-            outcode = ""
-            postcode = code_db.find_closest_postcode(i['lon'], i['lat'])
-            print(f"FOUNDPOSTCODE: {postcode}")
-            postcode_detail = code_db.lookup_postcode(postcode)
-
-            try:
-                postcode_lat = postcode_detail[0][1]
-                postcode_lon = postcode_detail[0][0]
-            except:
-                postcode = "XX99 9ZZ"
-                postcode_lat = 56.816918399
-                postcode_lon = -4.1826492694
-
-            outcode = postcode.split(" ")
-            outcode = outcode[0]
-            print(f"FOUNDOUTCODE: ✅ {outcode}")
-            outcode_detail = code_db.lookup_outcode(outcode)
-
-            try:
-                outcode_lat = outcode_detail[0][1]
-                outcode_lon = outcode_detail[0][0]
-            except:
-                outcode = "XX99"
-                outcode_lat = 56.816918399
-                outcode_lon = -4.1826492694
-
-            postcode_update = {"postcode" : postcode, "postcode_lat" : postcode_lat, "postcode_lon" : postcode_lon}
-            outcode_update = {"outcode" : outcode, "outcode_lat" : outcode_lat, "outcode_lon" : outcode_lon}
-            i.update(postcode_update)
-            i.update(outcode_update)
-            updated_json.append(i)
-        
-        with open(self.temp_dir + self.file_name, "w", encoding="utf-8") as f:
-            f.write(json.dumps(updated_json, ensure_ascii=False))
-        f.close()
+        for partition, writer in self.writers.items():
+            output_key = f"processed/{partition}/{self.file_name}"
+            print(f"UPLOADTOS3: Uploading {writer.rows} records to bucket: {self.bucket}, key: {output_key}")
+            s3.upload_file(writer.where, self.bucket, output_key)
+            os.remove(writer.where)
+            # Tells the compactor the partition has new data
+            s3.put_object(Bucket=self.bucket, Key=f"{processed_schema.TOUCHED_PREFIX}{partition}/{self.file_name}",
+                Body=b"")
 
 
 @dataclass
@@ -163,18 +602,33 @@ class Application:
     file_obj : DataFile
 
     def __post_init__(self):
-        self.file_obj.download_from_s3()
-        self.file_obj.transform_to_json()
-        self.file_obj.postcode_enrich_json()
-        self.file_obj.transform_to_parquet()
-        self.file_obj.upload_to_s3()
+        if self.file_obj.transform():
+            self.file_obj.upload_to_s3()
+        else:
+            print(f"EMPTYFILE: No readings in {self.file_obj.key}")
+
+
+def transform_file(bucket, key):
+    Application(DataFile(bucket, key))
 
 
 # Lambda handler
 def handler(event, context):
-    if event["Records"][0]["eventSource"] == "aws:s3":
-        print("S3EVENT : New object notification")
-        bucket = event["Records"][0]["s3"]["bucket"]["name"]
-        key = event["Records"][0]["s3"]["object"]["key"]
-        s3_obj = DataFile(bucket, key)
-        Application(s3_obj)
\ No newline at end of file
+    objects = [(record["s3"]["bucket"]["name"], unquote_plus(record["s3"]["object"]["key"]))
+        for record in event["Records"] if record.get("eventSource") == "aws:s3"]
+    print(f"S3EVENT : {len(objects)} new object notifications")
+    if not objects:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(TRANSFORM_WORKERS, len(objects))) as executor:
+        futures = [executor.submit(transform_file, bucket, key) for bucket, key in objects]
+    failed = []
+    for (bucket, key), future in zip(objects, futures):
+        if future.exception() is not None:
+            print(f"TRANSFORMERROR: s3://{bucket}/{key} failed, {future.exception()!r}")
+            failed.append(key)
+
+    print(f"S3EVENT : {len(objects) - len(failed)} of {len(objects)} objects transformed")
+    if failed:
+        # The whole notification is retried, files already transformed are rewritten to the same keys
+        raise RuntimeError(f"{len(failed)} objects failed to transform: {', '.join(failed)}")
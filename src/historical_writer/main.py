@@ -1,13 +1,27 @@
 import boto3
+import base64
+import io
 import secrets
 import os
 import datetime
 import uuid
 
+import wire_format
+
+
+def decode_message(message, content_type):
+    if content_type == wire_format.CONTENT_TYPE:
+        data = base64.b64decode(message)
+        readings = sum(header["count"] for header in wire_format.iter_headers(io.BytesIO(data)))
+        print(f"SQSMESSAGE: {readings} readings in compact format")
+        return data
+    return message.encode("utf-8")
+
+
 def write_to_s3(message, time_slot):
 
     file_path = "/tmp/" + secrets.token_hex(6)
-    with open(file_path,'w') as f:
+    with open(file_path,'wb') as f:
         f.write(message)
     f.close()
 
@@ -34,5 +48,7 @@ def handler(event, context):
     if event["Records"][0]["eventSource"] == "aws:sqs":
         print("SQSEVENT : New message notification")
         message_body = event["Records"][0]["body"]
-        time_slot = event["Records"][0]["messageAttributes"]["timeslot"]["stringValue"]
-        write_to_s3(message_body, time_slot)
\ No newline at end of file
+        message_attributes = event["Records"][0]["messageAttributes"]
+        time_slot = message_attributes["timeslot"]["stringValue"]
+        content_type = message_attributes.get("format", {}).get("stringValue")
+        write_to_s3(decode_message(message_body, content_type), time_slot)
@@ -1,107 +1,421 @@
+import argparse
 import boto3
-import pandas as pd
-from datetime import datetime
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as fs
+import pyarrow.parquet as pq
+from datetime import datetime, timezone
 import secrets
 import os
-import glob
+import time
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import processed_schema
 
 S3_BUCKET = os.environ.get('DATA_BUCKET')
 ROOT_KEY = 'processed/'
+# Partitions are year=/month=/day=/city= below the root
+PARTITION_DEPTH = 4
+DISCOVERY_WORKERS = int(os.environ.get('DISCOVERY_WORKERS', 16))
+
+# Compactions run in parallel, one per MEMORY_PER_WORKER_MB of function memory
+MEMORY_PER_WORKER_MB = 256
+# Stop starting partitions this long before the timeout and leave a cursor for the next run
+TIMEOUT_MARGIN_MS = 120000
+CURSOR_KEY = "checkpoints/compaction/cursor"
+# data_transform leaves a marker per output file under TOUCHED_PREFIX, runs only visit the marked partitions and
+# record what they did in a manifest per partition under MANIFEST_PREFIX. MANIFEST_KEY holds the marker watermark and
+# whether a full scan has completed, until then, or with COMPACTION_FULL_SCAN, all of processed/ is listed.
+TOUCHED_PREFIX = processed_schema.TOUCHED_PREFIX
+MANIFEST_KEY = "checkpoints/compaction/manifest.json"
+MANIFEST_PREFIX = "checkpoints/compaction/partitions/"
+COMPACTION_FULL_SCAN = os.environ.get('COMPACTION_FULL_SCAN', 'false').lower() == 'true'
+SCHEMA_HASH = hashlib.sha256(processed_schema.SCHEMA.to_string().encode("utf-8")).hexdigest()[:16]
 
-CURRENT_YEAR = datetime.now().year
-CURRENT_MONTH = datetime.now().month
-CURRENT_DAY = datetime.now().day
+# Compacted files are rolled over at this size, inputs are read this many rows at a time
+COMPACT_FILE_BYTES = int(os.environ.get('COMPACT_FILE_BYTES', 256 * 1024 * 1024))
+READ_BATCH_ROWS = 65536
+# Compacted rows are sorted by COMPACT_SORT_KEYS so row group statistics are selective, an empty value keeps the read
+# order. At most COMPACT_SORT_ROWS rows are sorted in memory at once, larger partitions are sorted in runs that are
+# merged. Row groups of COMPACT_ROW_GROUP_SIZE rows keep a single truck to a few of them.
+COMPACT_SORT_KEYS = tuple(key for key in os.environ.get('COMPACT_SORT_KEYS', 'truck_id,timestamp').split(",") if key)
+# Peak Arrow memory per row while a run is read, sorted and written. Sorting uses half of a worker's memory, the
+# rest is left to the runtime and the writer's row group.
+SORT_BYTES_PER_ROW = 192
+COMPACT_SORT_ROWS = int(os.environ.get('COMPACT_SORT_ROWS',
+    MEMORY_PER_WORKER_MB * 1024 * 1024 // 2 // SORT_BYTES_PER_ROW))
+COMPACT_ROW_GROUP_SIZE = int(os.environ.get('COMPACT_ROW_GROUP_SIZE', 131072))
 
 s3 = boto3.client('s3')
+S3_FS = fs.S3FileSystem(region=os.environ.get('AWS_REGION', 'eu-west-1'))
+
+
+def is_today(partition, today):
+    values = processed_schema.parse_partition(partition)
+    return (values.get("year"), values.get("month"), values.get("day")) == \
+        (f"{today.year}", f"{today.month:02d}", f"{today.day:02d}")
+
+
+def open_input(key):
+    return S3_FS.open_input_file(f"{S3_BUCKET}/{key}")
+
+
+def open_output(key):
+    return S3_FS.open_output_stream(f"{S3_BUCKET}/{key}")
 
-def parquet_compaction(keys):
-    print("PARQUETCOMPACT: Starting compaction")
-    files = []
+
+def read_batches(keys):
+    # Inputs are read straight from S3 a batch at a time, already compacted files are inputs too
     for key in keys:
-        full_key = key.split("/")
-        if full_key[1] == CURRENT_YEAR and full_key[2] == CURRENT_MONTH and full_key[3] == CURRENT_DAY:
-            print("PARQUETCOMPACT: todays files, exiting")
-            exit()
+        with open_input(key) as f:
+            for batch in pq.ParquetFile(f, read_dictionary=processed_schema.DICTIONARY_COLUMNS).iter_batches(
+                    batch_size=READ_BATCH_ROWS):
+                yield from processed_schema.conform(pa.Table.from_batches([batch])).to_batches()
 
-        file_name = full_key[-1]
-        if file_name.endswith(".parquet"):
-            continue
 
-        key_path = full_key[:-1]
-        key_path = "/".join(key_path)
-        files.append(files)
-        print("PARQUETCOMPACT: Downloading S3 files")
-        s3.download_file(S3_BUCKET, key, "/tmp/" + file_name + ".parquet")
+def sort_batches(batches):
+    table = pa.Table.from_batches(batches, schema=processed_schema.SCHEMA).unify_dictionaries()
+    return processed_schema.sort_table(table, COMPACT_SORT_KEYS)
+
+
+def write_run(table):
+    path = "/tmp/" + secrets.token_hex(6)
+    writer = processed_schema.RowGroupWriter(path, row_group_size=READ_BATCH_ROWS)
+    for batch in table.to_batches(max_chunksize=READ_BATCH_ROWS):
+        writer.write(batch)
+    writer.close()
+    return path
+
+
+def next_table(reader):
+    batch = next(reader, None)
+    return None if batch is None else processed_schema.conform(pa.Table.from_batches([batch]))
+
 
-    print("PARQUETCOMPACT: Combining Parquet")
-    data = pd.read_parquet("/tmp")
+def last_key(table):
+    return tuple(table.column(key)[table.num_rows - 1].as_py() for key in COMPACT_SORT_KEYS)
 
-    combined_file = secrets.token_hex(6)
-    data.to_parquet("/tmp/" + combined_file)
 
-    with open("/tmp/" + combined_file, "rb") as f:
-        s3.upload_fileobj(f, S3_BUCKET, key_path + "/" + combined_file + ".parquet")
+def count_up_to(table, cutoff):
+    # Rows are sorted, so the rows with keys at or before the cutoff are a prefix of the table
+    mask = None
+    for key, value in reversed(list(zip(COMPACT_SORT_KEYS, cutoff))):
+        column = processed_schema.decode(table.column(key))
+        value = pa.scalar(value, column.type)
+        if mask is None:
+            mask = pc.less_equal(column, value)
+        else:
+            mask = pc.or_(pc.less(column, value), pc.and_(pc.equal(column, value), mask))
+    return pc.sum(mask).as_py() or 0
+
+
+def merge_runs(runs):
+    # Rows up to the smallest last key buffered from any run are in their final order once merged, each round
+    # empties at least one buffer. The buffers hold about one output row group across all runs.
+    batch_rows = max(1024, COMPACT_ROW_GROUP_SIZE // len(runs))
+    # Without pre_buffer the reader would load each run whole
+    readers = [pq.ParquetFile(path, read_dictionary=processed_schema.DICTIONARY_COLUMNS, pre_buffer=False)
+        .iter_batches(batch_size=batch_rows) for path in runs]
+    buffers = [next_table(reader) for reader in readers]
+    while any(buffer is not None for buffer in buffers):
+        active = [i for i, buffer in enumerate(buffers) if buffer is not None]
+        cutoff = min(last_key(buffers[i]) for i in active)
+        parts = []
+        for i in active:
+            count = count_up_to(buffers[i], cutoff)
+            parts.append(buffers[i].slice(0, count))
+            buffers[i] = buffers[i].slice(count) if count < buffers[i].num_rows else next_table(readers[i])
+        merged = processed_schema.sort_table(pa.concat_tables(parts).unify_dictionaries(), COMPACT_SORT_KEYS)
+        yield from merged.to_batches(max_chunksize=COMPACT_ROW_GROUP_SIZE)
+
+
+def sorted_batches(keys):
+    # Inputs are read once, COMPACT_SORT_ROWS rows at a time are sorted into runs in local storage and the runs are
+    # merged. A partition that fits in one run is sorted in memory without spilling.
+    runs = []
+    try:
+        batches = []
+        rows = 0
+        for batch in read_batches(keys):
+            batches.append(batch)
+            rows += batch.num_rows
+            if rows >= COMPACT_SORT_ROWS:
+                runs.append(write_run(sort_batches(batches)))
+                batches = []
+                rows = 0
+        if not runs:
+            yield from sort_batches(batches).to_batches(max_chunksize=COMPACT_ROW_GROUP_SIZE)
+            return
+        if batches:
+            runs.append(write_run(sort_batches(batches)))
+        batches = None
+        print(f"PARQUETCOMPACT: Merging {len(runs)} sorted runs")
+        yield from merge_runs(runs)
+    finally:
+        for path in runs:
+            os.remove(path)
+
+
+def parquet_compaction(partition, keys):
+    # Streams every file in the partition into new files of around COMPACT_FILE_BYTES, the inputs are only
+    # deleted once all outputs are written. Memory is bounded by COMPACT_SORT_ROWS rows, or one row group unsorted.
+    outputs = []
+    rows = 0
+    stream = writer = None
+    try:
+        for batch in sorted_batches(keys) if COMPACT_SORT_KEYS else read_batches(keys):
+            if writer is None:
+                outputs.append(partition + secrets.token_hex(6) + ".parquet")
+                stream = open_output(outputs[-1])
+                writer = processed_schema.RowGroupWriter(stream, row_group_size=COMPACT_ROW_GROUP_SIZE,
+                    sort_keys=COMPACT_SORT_KEYS)
+            writer.write(batch)
+            rows += batch.num_rows
+            if stream.tell() >= COMPACT_FILE_BYTES:
+                writer.close()
+                stream.close()
+                stream = writer = None
+        if writer is not None:
+            writer.close()
+            stream.close()
+    except Exception:
+        if writer is not None:
+            writer.close()
+            stream.close()
+        for key in outputs:
+            s3.delete_object(Bucket=S3_BUCKET, Key=key)
+        raise
 
-    print("PARQUETCOMPACT: Deleting old files")
     for key in keys:
         s3.delete_object(Bucket=S3_BUCKET, Key=key)
+    print(f"PARQUETCOMPACT: Compacted {len(keys)} files into {', '.join(outputs)}")
+    return outputs, rows
 
-    files = glob.glob('/tmp/*')
-    for f in files:
-        os.remove(f)
 
-    print(f"PARQUETCOMPACT: Finished compaction for {key_path}, exiting")
-    exit()
+def list_prefix(prefix):
+    prefixes = []
+    objects = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix, Delimiter='/'):
+        prefixes.extend(i['Prefix'] for i in page.get('CommonPrefixes', []))
+        objects.extend(page.get('Contents', []))
+    return prefix, prefixes, objects
 
-def get_s3_folders():
 
-    def s3_prefix_response(prefix):
-        result = s3.list_objects(Bucket=S3_BUCKET, Prefix=prefix, Delimiter='/')
-        if 'CommonPrefixes' in result.keys():
-            return result['CommonPrefixes']
-        else:
-            return None 
-
-    l1_prefixes = []
-    for i in s3_prefix_response(ROOT_KEY):
-        l1_prefixes.append(i['Prefix'])
-
-    l2_prefixes = [] 
-    for i in l1_prefixes:
-        result = s3_prefix_response(i)
-        if result is not None:
-            for j in result:
-                l2_prefixes.append(j['Prefix'])   
-
-    l3_prefixes = [] 
-    for i in l2_prefixes:
-        result = s3_prefix_response(i)
-        if result is not None:
-            for j in result:
-                l3_prefixes.append(j['Prefix'])   
-
-    l4_prefixes = [] 
-    for i in l3_prefixes:
-        result = s3_prefix_response(i)
-        if result is not None:
-            for j in result:
-                l4_prefixes.append(j['Prefix'])   
-
-    def s3_objects_response(prefix):
-        result = s3.list_objects(Bucket=S3_BUCKET, Prefix=prefix, Delimiter='/')
-        if 'Contents' in result.keys():
-            return result['Contents']
-        else:
-            return None 
+def discover_partitions(start_after=None, remaining=None):
+    # Walks processed/ a level at a time on a pool of listers, yielding each partition as soon as it is listed.
+    # Prefixes wholly before start_after are not listed, prefixes still unlisted when the caller stops are
+    # added to remaining.
+    partitions = 0
+    with ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS) as executor:
+        pending = {executor.submit(list_prefix, ROOT_KEY) : (ROOT_KEY, 0)}
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _, depth = pending.pop(future)
+                    prefix, prefixes, objects = future.result()
+                    if depth < PARTITION_DEPTH:
+                        for child in prefixes:
+                            if start_after and child < start_after and not start_after.startswith(child):
+                                continue
+                            pending[executor.submit(list_prefix, child)] = (child, depth + 1)
+                    elif objects:
+                        partitions += 1
+                        yield prefix, [i['Key'] for i in objects], [i['Size'] for i in objects], []
+        finally:
+            if remaining is not None:
+                remaining.extend(prefix for prefix, _ in pending.values())
+    print(f"PARQUETCOMPACT: Discovered {partitions} partitions")
+
+
+def discover_touched():
+    # Markers are checkpoints/compaction/touched/year=/month=/day=/city=/<source file>
+    markers = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=TOUCHED_PREFIX):
+        for i in page.get('Contents', []):
+            partition = ROOT_KEY + i['Key'][len(TOUCHED_PREFIX):].rsplit("/", 1)[0] + "/"
+            markers.setdefault(partition, []).append(i)
+    print(f"PARQUETCOMPACT: {len(markers)} partitions touched since the last run")
+
+    with ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS) as executor:
+        for prefix, _, objects in executor.map(list_prefix, sorted(markers)):
+            yield prefix, [i['Key'] for i in objects], [i['Size'] for i in objects], markers[prefix]
+
+
+def read_manifest():
+    try:
+        return json.loads(s3.get_object(Bucket=S3_BUCKET, Key=MANIFEST_KEY)["Body"].read())
+    except s3.exceptions.NoSuchKey:
+        return {}
+
 
-    for prefix in l4_prefixes:
-        result = s3_objects_response(prefix)
-        keys = []
-        for i in result:
-            keys.append(i['Key'])
-        if len(keys) > 1:
-            parquet_compaction(keys)
+def write_manifest(key, manifest):
+    s3.put_object(Bucket=S3_BUCKET, Key=key, Body=json.dumps(manifest).encode("utf-8"))
+
+
+def partition_manifest_key(partition):
+    return MANIFEST_PREFIX + partition[len(ROOT_KEY):] + "manifest.json"
+
+
+def delete_markers(markers):
+    for i in range(0, len(markers), 1000):
+        s3.delete_objects(Bucket=S3_BUCKET, Delete={"Objects" : [{"Key" : marker['Key']} for marker in markers[i:i + 1000]],
+            "Quiet" : True})
+
+
+def watermark(markers):
+    return max((marker['LastModified'] for marker in markers), default=None)
+
+
+def read_cursor():
+    try:
+        return s3.get_object(Bucket=S3_BUCKET, Key=CURSOR_KEY)["Body"].read().decode("utf-8")
+    except s3.exceptions.NoSuchKey:
+        return None
+
+
+def write_cursor(cursor):
+    if cursor is None:
+        s3.delete_object(Bucket=S3_BUCKET, Key=CURSOR_KEY)
+    else:
+        s3.put_object(Bucket=S3_BUCKET, Key=CURSOR_KEY, Body=cursor.encode("utf-8"))
+
+
+def get_workers(context):
+    memory = int(getattr(context, "memory_limit_in_mb", None) or os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 512))
+    return max(1, memory // MEMORY_PER_WORKER_MB)
+
+
+def compact_partitions(context):
+    start = time.time()
+    # Partitions are by UTC reading date, taken per run as warm containers outlive the day
+    today = datetime.now(timezone.utc).date()
+    manifest = read_manifest()
+    # Manifests from before the per partition objects listed every partition, they are rewritten without it
+    changed = manifest.pop("partitions", None) is not None
+    # Data written before the markers existed is only found by listing everything, once
+    full_scan = COMPACTION_FULL_SCAN or "full_scan" not in manifest
+    cursor = read_cursor() if full_scan else None
+    if cursor:
+        print(f"PARQUETCOMPACT: Resuming from {cursor}")
+
+    remaining = []
+    unfinished = []
+    running = {}
+    done_markers = []
+    compacted = 0
+    compacted_bytes = 0
+    partitions = discover_partitions(cursor, remaining) if full_scan else discover_touched()
+    workers = get_workers(context)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for partition, keys, sizes, markers in partitions:
+            # Today's partitions keep their markers so they are visited again once the day is complete
+            if is_today(partition, today):
+                continue
+            # Files already at the target size are left alone, so rolled over outputs are not compacted again
+            small = [(key, size) for key, size in zip(keys, sizes) if size < COMPACT_FILE_BYTES]
+            if len(small) < 2:
+                done_markers.extend(markers)
+                continue
+            keys, sizes = zip(*small)
+            # A partition is only started once a worker is free, so the time check holds for queued work too
+            active = [future for future in running if not future.done()]
+            if len(active) >= workers:
+                wait(active, return_when=FIRST_COMPLETED)
+            if context is not None and context.get_remaining_time_in_millis() < TIMEOUT_MARGIN_MS:
+                unfinished.append(partition)
+                break
+            running[executor.submit(parquet_compaction, partition, keys)] = (partition, keys, sum(sizes), markers)
+        partitions.close()
+
+    for future, (partition, keys, size, markers) in running.items():
+        if future.exception() is not None:
+            print(f"PARQUETCOMPACT: {partition} failed, {future.exception()!r}")
+            unfinished.append(partition)
+            continue
+        outputs, rows = future.result()
+        compacted += 1
+        compacted_bytes += size
+        done_markers.extend(markers)
+        write_manifest(partition_manifest_key(partition), {"inputs" : len(keys), "outputs" : outputs, "rows" : rows,
+            "schema" : SCHEMA_HASH, "watermark" : str(watermark(markers) or ""),
+            "compacted" : datetime.now().isoformat()})
+
+    # Markers of partitions that failed or were not reached stay for the next run
+    delete_markers(done_markers)
+    if done_markers:
+        manifest["watermark"] = str(watermark(done_markers))
+        changed = True
+    if full_scan:
+        # Everything before the earliest unfinished partition or unlisted prefix is done
+        write_cursor(min(unfinished + remaining, default=None))
+        if not unfinished and not remaining:
+            manifest["full_scan"] = datetime.now().isoformat()
+            changed = True
+    if changed:
+        write_manifest(MANIFEST_KEY, manifest)
+
+    seconds = time.time() - start
+    print(f"PARQUETCOMPACT: Compacted {compacted} partitions, {compacted_bytes / 1000000:.1f} MB in {seconds:.1f}s, "
+        f"{compacted / seconds:.2f} partitions/s, {compacted_bytes / 1000000 / seconds:.2f} MB/s")
 
 
 def handler(event, context):
-    get_s3_folders()
\ No newline at end of file
+    compact_partitions(context)
+
+
+def run_measure(args):
+    # Reports how much of a processed/ tree a single truck history query reads once row groups are pruned on
+    # their statistics, point it at a synced copy of processed/ or an s3:// URI
+    dataset = ds.dataset(args.path, format="parquet", partitioning="hive")
+    expression = ds.field("truck_id") == args.truck
+    if args.begin:
+        expression &= ds.field("timestamp") >= pa.scalar(datetime.fromisoformat(args.begin), pa.timestamp("ms"))
+    if args.end:
+        expression &= ds.field("timestamp") < pa.scalar(datetime.fromisoformat(args.end), pa.timestamp("ms"))
+    # Files are pruned on the city partition, row groups on their statistics
+    city = ds.field("city") == processed_schema.city_of(args.truck) if "city" in dataset.schema.names else None
+    matching = {fragment.path for fragment in dataset.get_fragments(filter=city)}
+
+    total_groups = total_bytes = read_groups = read_bytes = 0
+    for fragment in dataset.get_fragments():
+        sizes = [group.total_byte_size for group in fragment.row_groups]
+        total_groups += len(sizes)
+        total_bytes += sum(sizes)
+        if fragment.path in matching:
+            for part in fragment.split_by_row_group(filter=expression):
+                read_groups += len(part.row_groups)
+                read_bytes += sum(group.total_byte_size for group in part.row_groups)
+    if city is not None:
+        expression &= city
+
+    start = time.time()
+    rows = dataset.to_table(filter=expression).num_rows
+    seconds = time.time() - start
+    print(f"MEASURE: {rows} rows for {args.truck} in {seconds:.2f}s")
+    print(f"MEASURE: Read {read_groups} of {total_groups} row groups, {read_bytes / 1000000:.1f} of "
+        f"{total_bytes / 1000000:.1f} MB, skipped {1 - read_bytes / max(total_bytes, 1):.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Waste collection parquet compaction")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    measure = subparsers.add_parser("measure", help="measure row group pruning for a single truck query")
+    measure.add_argument("path", help="processed/ directory or s3:// URI")
+    measure.add_argument("--truck", required=True, help="truck id, e.g. gla0001")
+    measure.add_argument("--begin", help="readings from this time")
+    measure.add_argument("--end", help="readings before this time")
+    measure.set_defaults(func=run_measure)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()